@@ -0,0 +1,219 @@
+"""Cold storage for old chat history.
+
+Messages sent more than ``settings.MESSAGE_ARCHIVE_AFTER`` seconds ago are
+moved out of ``api_message`` by ``archive_messages`` into ``MessageArchive``
+chunks: runs of up to ``settings.MESSAGE_ARCHIVE_CHUNK_SIZE`` messages of one
+chat in history order, stored as zlib-compressed JSON, each with the
+``(sent_at, id)`` range it covers. The message table and its indexes, the
+full-text index included, then only grow with recent history, which is what
+almost every read asks for.
+
+``MessageCursorPagination`` reads through: when a page of a chat's history
+reaches past what is still hot, the rest comes from the chunks whose ranges
+are next to its position, as unsaved ``Message`` instances that serialize like
+any other. A page decompresses about a page's worth of chunks, however deep
+in the history it is. A later run can archive messages that fall inside the
+range of earlier chunks, so chunks may overlap and reads merge them.
+
+A chat's last message and every read cursor stay hot, because rows point at
+them. Archived messages are history: they drop out of search, can no longer
+be edited or deleted one by one, and are not announced to syncing clients,
+which received them long before the sync log was pruned. Moving them skips
+the delete signals, so the media they point at stay counted.
+"""
+import json
+import zlib
+from datetime import timedelta
+from itertools import groupby
+from operator import itemgetter
+
+from django.conf import settings
+from django.db import connections, router, transaction
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .models import Chat, ChatReadState, Message, MessageArchive, User
+
+# Message columns kept in the archive; the chat is the chunk's.
+FIELDS = ('id', 'sender_id', 'text', 'image', 'image_variants', 'sent_at', 'is_read')
+
+# Chunks fetched per query while reading; a page rarely needs more.
+CHUNKS_PER_FETCH = 4
+
+
+def position_of(entry):
+    return entry['sent_at'], entry['id']
+
+
+def encode(entries):
+    # isoformat() keeps the microseconds that positions compare on.
+    entries = [dict(entry, sent_at=entry['sent_at'].isoformat()) for entry in entries]
+    return zlib.compress(json.dumps(entries, separators=(',', ':')).encode())
+
+
+def decode(chunk):
+    """The chunk's entries, in history order"""
+    entries = json.loads(zlib.decompress(bytes(chunk.data)))
+    for entry in entries:
+        entry['sent_at'] = parse_datetime(entry['sent_at'])
+    return entries
+
+
+def fill(chunk, entries):
+    """Point the chunk at entries, which are in history order"""
+    chunk.first_sent_at, chunk.first_message_id = position_of(entries[0])
+    chunk.last_sent_at, chunk.last_message_id = position_of(entries[-1])
+    chunk.min_id = min(entry['id'] for entry in entries)
+    chunk.max_id = max(entry['id'] for entry in entries)
+    chunk.count = len(entries)
+    # One name per message, matching the references counted while they were hot.
+    chunk.images = [entry['image'] for entry in entries if entry['image']]
+    chunk.data = encode(entries)
+
+
+def store(chat_id, entries):
+    """Append entries of a chat, in history order, to its archive as chunks"""
+    size = settings.MESSAGE_ARCHIVE_CHUNK_SIZE
+    # Top up the chat's newest chunk when the entries carry on after it, so
+    # the end of each batch does not leave a small chunk behind.
+    tail = (
+        MessageArchive.objects.select_for_update().filter(chat_id=chat_id)
+        .order_by('-last_sent_at', '-last_message_id').first()
+    )
+    if tail is not None and tail.count < size and (tail.last_sent_at, tail.last_message_id) < position_of(entries[0]):
+        room = size - tail.count
+        fill(tail, decode(tail) + entries[:room])
+        tail.save()
+        entries = entries[room:]
+
+    chunks = []
+    for start in range(0, len(entries), size):
+        chunk = MessageArchive(chat_id=chat_id)
+        fill(chunk, entries[start:start + size])
+        chunks.append(chunk)
+    MessageArchive.objects.bulk_create(chunks)
+
+
+def delete_moved(message_ids):
+    """Delete archived rows in SQL, without the signals of QuerySet.delete().
+
+    The messages live on in the archive, so there is nothing to announce, no
+    media reference to drop and no chat or cursor to move back. Nothing else
+    points at them: the chat's last message and read cursors stay hot.
+    """
+    with connections[router.db_for_write(Message)].cursor() as cursor:
+        cursor.execute(
+            f'DELETE FROM {Message._meta.db_table} WHERE id IN ({", ".join(["%s"] * len(message_ids))})',
+            message_ids,
+        )
+
+
+def archive_messages(older_than=None, batch_size=None):
+    """Move messages sent more than older_than seconds ago into the archive and return how many moved"""
+    older_than = settings.MESSAGE_ARCHIVE_AFTER if older_than is None else older_than
+    batch_size = batch_size or settings.MESSAGE_ARCHIVE_BATCH_SIZE
+    candidates = (
+        Message.objects.filter(sent_at__lt=timezone.now() - timedelta(seconds=older_than))
+        .exclude(id__in=Chat.objects.filter(last_message__isnull=False).values('last_message_id'))
+        .exclude(id__in=ChatReadState.objects.filter(last_read_message__isnull=False).values('last_read_message_id'))
+        # Each chat's messages in history order, so they are appended in runs.
+        .order_by('chat_id', 'sent_at', 'id')
+    )
+
+    moved = 0
+    while True:
+        with transaction.atomic():
+            rows = list(candidates.values('chat_id', *FIELDS)[:batch_size])
+            if not rows:
+                return moved
+            for chat_id, chat_rows in groupby(rows, key=itemgetter('chat_id')):
+                store(chat_id, [{field: row[field] for field in FIELDS} for row in chat_rows])
+            delete_moved([row['id'] for row in rows])
+        moved += len(rows)
+
+
+def to_messages(chat_id, entries):
+    """Unsaved Message instances for entries, with their senders loaded"""
+    senders = User.objects.in_bulk({entry['sender_id'] for entry in entries})
+    messages = []
+    for entry in entries:
+        if entry['sender_id'] not in senders:
+            # The sender's account is gone, as are its hot messages.
+            continue
+        message = Message(chat_id=chat_id, **{field: entry[field] for field in FIELDS})
+        message.sender = senders[entry['sender_id']]
+        message._state.adding = False
+        messages.append(message)
+    return messages
+
+
+def before(prefix, position):
+    """Chunks whose first or last (the prefix) message comes before position"""
+    sent_at, message_id = position
+    return Q(**{f'{prefix}_sent_at__lte': sent_at}) & (
+        Q(**{f'{prefix}_sent_at__lt': sent_at}) | Q(**{f'{prefix}_message_id__lt': message_id})
+    )
+
+
+def after(prefix, position):
+    """Chunks whose first or last (the prefix) message comes after position"""
+    sent_at, message_id = position
+    return Q(**{f'{prefix}_sent_at__gte': sent_at}) & (
+        Q(**{f'{prefix}_sent_at__gt': sent_at}) | Q(**{f'{prefix}_message_id__gt': message_id})
+    )
+
+
+def messages_before(chat_id, position, limit, floor=None):
+    """Up to limit archived messages of the chat before position, newest first.
+
+    Only messages after floor are wanted. Chunks are read by their last
+    message, newest first, until the next one ends before the limit-th
+    message found.
+    """
+    chunks = MessageArchive.objects.filter(chat_id=chat_id)
+    if position is not None:
+        chunks = chunks.filter(before('first', position))
+    if floor is not None:
+        chunks = chunks.filter(after('last', floor))
+
+    found = []
+    for chunk in chunks.order_by('-last_sent_at', '-last_message_id').iterator(chunk_size=CHUNKS_PER_FETCH):
+        if len(found) == limit and (chunk.last_sent_at, chunk.last_message_id) < position_of(found[-1]):
+            break
+        found += [
+            entry for entry in decode(chunk)
+            if (position is None or position_of(entry) < position) and (floor is None or position_of(entry) > floor)
+        ]
+        found = sorted(found, key=position_of, reverse=True)[:limit]
+    return to_messages(chat_id, found)
+
+
+def messages_after(chat_id, position, limit, ceiling=None):
+    """Up to limit archived messages of the chat after position, oldest first, and before ceiling"""
+    chunks = MessageArchive.objects.filter(chat_id=chat_id)
+    if position is not None:
+        chunks = chunks.filter(after('last', position))
+    if ceiling is not None:
+        chunks = chunks.filter(before('first', ceiling))
+
+    found = []
+    for chunk in chunks.order_by('first_sent_at', 'first_message_id').iterator(chunk_size=CHUNKS_PER_FETCH):
+        if len(found) == limit and (chunk.first_sent_at, chunk.first_message_id) > position_of(found[-1]):
+            break
+        found += [
+            entry for entry in decode(chunk)
+            if (position is None or position_of(entry) > position) and (ceiling is None or position_of(entry) < ceiling)
+        ]
+        found = sorted(found, key=position_of)[:limit]
+    return to_messages(chat_id, found)
+
+
+def find_position(chat_id, message_id):
+    """(sent_at, id) of an archived message of the chat, or None"""
+    chunks = MessageArchive.objects.filter(chat_id=chat_id, min_id__lte=message_id, max_id__gte=message_id)
+    for chunk in chunks.iterator(chunk_size=CHUNKS_PER_FETCH):
+        for entry in decode(chunk):
+            if entry['id'] == message_id:
+                return position_of(entry)
+    return None
@@ -0,0 +1,132 @@
+"""Shared helpers for the bench_* management commands."""
+import itertools
+import os
+import random
+import statistics
+import tempfile
+import time
+from contextlib import contextmanager
+from datetime import timedelta
+
+from django.core.management import call_command
+from django.db import connections
+from django.utils import timezone
+
+from api.models import Chat, Message, User
+
+BENCH_ALIAS = 'bench'
+
+SYLLABLES = ['ka', 'lo', 'mi', 'ne', 'ru', 'sa', 'ti', 'vo', 'ze', 'da', 'pe', 'gu']
+
+
+def vocabulary(size=5000, seed_value=7):
+    """Distinct made-up words; used with Zipf weights so a few are everywhere and most are rare"""
+    rng = random.Random(seed_value)
+    words = set()
+    while len(words) < size:
+        words.add(''.join(rng.choices(SYLLABLES, k=rng.randint(2, 4))))
+    return sorted(words)
+
+
+@contextmanager
+def scratch_database(path=None, options=None):
+    """Register a SQLite database under the 'bench' alias and migrate it.
+
+    Without a path a temporary file is used and removed afterwards; with a path
+    the file is kept so a large seed can be reused across runs. options replace
+    the OPTIONS of the default database.
+    """
+    temporary = path is None
+    if temporary:
+        fd, path = tempfile.mkstemp(suffix='.sqlite3')
+        os.close(fd)
+
+    connections.databases[BENCH_ALIAS] = dict(
+        connections.databases['default'],
+        ENGINE='django.db.backends.sqlite3',
+        NAME=path,
+    )
+    if options is not None:
+        connections.databases[BENCH_ALIAS]['OPTIONS'] = options
+    try:
+        call_command('migrate', database=BENCH_ALIAS, verbosity=0)
+        yield BENCH_ALIAS
+    finally:
+        connections[BENCH_ALIAS].close()
+        del connections[BENCH_ALIAS]
+        del connections.databases[BENCH_ALIAS]
+        if temporary:
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(path + suffix):
+                    os.remove(path + suffix)
+
+
+def seed(alias, users=1000, chats=5000, messages=1_000_000, group_size=4,
+         batch_size=20000, stdout=None, seed_value=42):
+    """Fill the database with users, chats and a skewed message history"""
+    rng = random.Random(seed_value)
+    start = timezone.now() - timedelta(days=365)
+
+    User.objects.using(alias).bulk_create(
+        [User(username=f'bench{i}', email=f'bench{i}@example.com', password='!') for i in range(users)],
+        batch_size=batch_size,
+    )
+    user_ids = list(User.objects.using(alias).values_list('id', flat=True))
+
+    Chat.objects.using(alias).bulk_create(
+        [Chat(name=f'chat {i}', is_group=True) for i in range(chats)],
+        batch_size=batch_size,
+    )
+    chat_ids = list(Chat.objects.using(alias).values_list('id', flat=True))
+
+    members = {}
+    through = Chat.participants.through
+    rows = []
+    for chat_id in chat_ids:
+        members[chat_id] = rng.sample(user_ids, min(group_size, len(user_ids)))
+        rows.extend(through(chat_id=chat_id, user_id=user_id) for user_id in members[chat_id])
+    through.objects.using(alias).bulk_create(rows, batch_size=batch_size)
+
+    # A few chats carry most of the traffic, like long-lived group chats do.
+    weights = [1.0 / (rank + 1) for rank in range(len(chat_ids))]
+    words = vocabulary()
+    word_weights = list(itertools.accumulate(1.0 / (rank + 1) for rank in range(len(words))))
+    step = timedelta(days=365) / max(messages, 1)
+    written = 0
+    while written < messages:
+        count = min(batch_size, messages - written)
+        batch = []
+        for chat_id in rng.choices(chat_ids, weights=weights, k=count):
+            batch.append(Message(
+                chat_id=chat_id,
+                sender_id=rng.choice(members[chat_id]),
+                text=' '.join(rng.choices(words, cum_weights=word_weights, k=rng.randint(3, 15))),
+                sent_at=start + step * (written + len(batch)),
+            ))
+        Message.objects.using(alias).bulk_create(batch)
+        written += count
+        if stdout:
+            stdout.write(f'\rseeded {written}/{messages} messages', ending='')
+            stdout.flush()
+    if stdout:
+        stdout.write('')
+
+
+def measure(fn, repeat=20):
+    """Run fn repeat times and return latency stats in milliseconds"""
+    fn()
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - started) * 1000)
+    samples.sort()
+    return {
+        'median': statistics.median(samples),
+        'p95': samples[min(len(samples) - 1, int(len(samples) * 0.95))],
+        'max': samples[-1],
+    }
+
+
+def format_stats(stats):
+    return 'median {median:8.3f} ms  p95 {p95:8.3f} ms  max {max:8.3f} ms'.format(**stats)
@@ -0,0 +1,23 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from api import archive
+
+
+class Command(BaseCommand):
+    help = "Move messages older than MESSAGE_ARCHIVE_AFTER into the compressed per-chat archive."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than', type=int, default=None, metavar='SECONDS',
+                            help='Archive messages sent more than SECONDS ago (default MESSAGE_ARCHIVE_AFTER)')
+        parser.add_argument('--batch-size', type=int, default=None, help='Messages moved per transaction')
+        parser.add_argument('--loop', type=int, default=0, metavar='SECONDS', help='Keep running, archiving every SECONDS')
+
+    def handle(self, *args, **options):
+        while True:
+            moved = archive.archive_messages(older_than=options['older_than'], batch_size=options['batch_size'])
+            self.stdout.write(f'{moved} messages archived')
+            if not options['loop']:
+                break
+            time.sleep(options['loop'])
@@ -0,0 +1,170 @@
+import multiprocessing
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections, connections
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from api.models import Chat, User
+
+from ._bench import format_stats, scratch_database
+
+USERNAME_PREFIX = 'dbwriter-'
+
+
+@contextmanager
+def as_default(alias):
+    """Point the default alias at another database, so views and signals write there"""
+    original = connections.databases['default']
+    connections['default'].close()
+    del connections['default']
+    connections.databases['default'] = connections.databases[alias]
+    try:
+        yield
+    finally:
+        connections['default'].close()
+        del connections['default']
+        connections.databases['default'] = original
+
+
+def api_writer(user, chat_ids, count, results):
+    """Post messages through MessageViewSet like the REST API does"""
+    from api.views import MessageViewSet
+
+    view = MessageViewSet.as_view({'post': 'create'})
+    factory = APIRequestFactory()
+    for i in range(count):
+        request = factory.post('/api/messages/', {'chat': random.choice(chat_ids), 'text': f'api {i}'})
+        force_authenticate(request, user)
+        started = time.perf_counter()
+        try:
+            response = view(request)
+            error = None if response.status_code == 201 else str(response.data)
+        except Exception as e:
+            error = f'{type(e).__name__}: {e}'
+        results.append((time.perf_counter() - started, error))
+
+
+def socket_writer(user, chat_ids, count, results):
+    """Store messages through socket_server.create_message like message_create does"""
+    from socket_server import create_message
+
+    for i in range(count):
+        started = time.perf_counter()
+        try:
+            create_message(user, random.choice(chat_ids), f'socket {i}')
+            error = None
+        except Exception as e:
+            error = f'{type(e).__name__}: {e}'
+        results.append((time.perf_counter() - started, error))
+
+
+def run_process(side, user_ids, chat_ids, count, start, queue):
+    """One API worker or socket server: a thread per user, writing count messages each"""
+    writer = api_writer if side == 'api' else socket_writer
+    results = []
+    users = list(User.objects.filter(id__in=user_ids))
+    threads = [threading.Thread(target=run_thread, args=(writer, user, chat_ids, count, results)) for user in users]
+    start.wait()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    queue.put(results)
+
+
+def run_thread(writer, user, chat_ids, count, results):
+    try:
+        writer(user, chat_ids, count, results)
+    finally:
+        close_old_connections()
+
+
+class Command(BaseCommand):
+    help = (
+        "Write messages concurrently from several processes, half through the REST "
+        "view and half through the socket server's create_message, and report "
+        "throughput, latency and lock errors. On SQLite a scratch database is run "
+        "with default and with tuned settings (settings.SQLITE_TUNED_OPTIONS); with "
+        "DATABASE_URL the configured database is used."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=2, help='Processes per side (API and socket server)')
+        parser.add_argument('--threads', type=int, default=4, help='Writer threads per process')
+        parser.add_argument('--messages', type=int, default=100, help='Messages per writer thread')
+        parser.add_argument('--chats', type=int, default=10)
+
+    def handle(self, *args, **options):
+        if connections['default'].vendor == 'sqlite':
+            modes = [('sqlite default', {}), ('sqlite tuned', settings.SQLITE_TUNED_OPTIONS)]
+            for label, sqlite_options in modes:
+                with scratch_database(options=sqlite_options) as alias, as_default(alias):
+                    self.run(label, options)
+        else:
+            self.run(connections['default'].vendor, options)
+
+    def run(self, label, options):
+        writers = options['processes'] * 2 * options['threads']
+        User.objects.filter(username__startswith=USERNAME_PREFIX).delete()
+        User.objects.bulk_create([User(username=f'{USERNAME_PREFIX}{i}', password='!') for i in range(writers)])
+        user_ids = list(User.objects.filter(username__startswith=USERNAME_PREFIX).values_list('id', flat=True))
+        chat_ids = []
+        for _ in range(options['chats']):
+            chat = Chat.objects.create(name=f'{USERNAME_PREFIX}chat', is_group=True)
+            chat.participants.set(user_ids)
+            chat_ids.append(chat.id)
+
+        try:
+            results, elapsed = self.write(user_ids, chat_ids, options)
+        finally:
+            Chat.objects.filter(id__in=chat_ids).delete()
+            User.objects.filter(id__in=user_ids).delete()
+
+        latencies = sorted(duration * 1000 for duration, error in results)
+        errors = [error for duration, error in results if error]
+        locked = sum('locked' in error for error in errors)
+        self.stdout.write(self.style.MIGRATE_HEADING(f'\n== {label} =='))
+        self.stdout.write(
+            f'{len(results)} writes from {writers} writers in {elapsed:.2f} s  '
+            f'({(len(results) - len(errors)) / elapsed:.0f} committed/s)'
+        )
+        self.stdout.write(format_stats({
+            'median': latencies[len(latencies) // 2],
+            'p95': latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))],
+            'max': latencies[-1],
+        }))
+        self.stdout.write(f'{len(errors)} failed, {locked} of them with a locked database')
+        for error in sorted(set(errors))[:5]:
+            self.stdout.write(f'  {error[:200]}')
+
+    def write(self, user_ids, chat_ids, options):
+        # Writers are forked so each has its own connections, like separate servers.
+        context = multiprocessing.get_context('fork')
+        start = context.Event()
+        queue = context.Queue()
+        per_process = options['threads']
+        groups = [user_ids[i:i + per_process] for i in range(0, len(user_ids), per_process)]
+        connections.close_all()
+        processes = [
+            context.Process(
+                target=run_process,
+                args=('api' if i % 2 == 0 else 'socket', group, chat_ids, options['messages'], start, queue),
+            )
+            for i, group in enumerate(groups)
+        ]
+        for process in processes:
+            process.start()
+        started = time.perf_counter()
+        start.set()
+        results = []
+        for _ in processes:
+            results.extend(queue.get())
+        elapsed = time.perf_counter() - started
+        for process in processes:
+            process.join()
+        return results, elapsed
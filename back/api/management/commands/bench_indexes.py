@@ -0,0 +1,83 @@
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from api.models import Chat, Message
+from api.pagination import MessageCursorPagination
+
+from ._bench import format_stats, measure, scratch_database, seed
+
+PARTICIPANTS_INDEX = 'api_chat_participants_user_chat_idx'
+
+
+class Command(BaseCommand):
+    help = (
+        "Seed a scratch SQLite database and report query plans and latencies "
+        "for the hot chat/message queries without and with the composite indexes."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=2_000_000)
+        parser.add_argument('--chats', type=int, default=20_000)
+        parser.add_argument('--users', type=int, default=10_000)
+        parser.add_argument('--repeat', type=int, default=50)
+        parser.add_argument('--db', help='Keep the seeded database at this path and reuse it on later runs')
+
+    def handle(self, *args, **options):
+        with scratch_database(options['db']) as alias:
+            if not Message.objects.using(alias).exists():
+                seed(alias, users=options['users'], chats=options['chats'],
+                     messages=options['messages'], stdout=self.stdout)
+
+            queries = self.hot_queries(alias)
+
+            self.drop_indexes(alias)
+            self.report(alias, 'without indexes', queries, options['repeat'])
+            self.create_indexes(alias)
+            self.report(alias, 'with indexes', queries, options['repeat'])
+
+    def hot_queries(self, alias):
+        messages = Message.objects.using(alias)
+        busiest = messages.order_by('-id').values_list('chat_id', flat=True).first()
+        chat = Chat.objects.using(alias).get(id=busiest)
+        user_id = chat.participants.values_list('id', flat=True).first()
+        middle = messages.filter(chat=chat).order_by('id')[
+            messages.filter(chat=chat).count() // 2
+        ]
+
+        history = messages.filter(chat=chat)
+        older = history.filter(MessageCursorPagination.before_filter(middle.sent_at, middle.id))
+        return [
+            ('newest history page', history.order_by('-sent_at', '-id')[:50]),
+            ('deep history page', older.order_by('-sent_at', '-id')[:50]),
+            ('last message of chat', history.order_by('-sent_at', '-id')[:1]),
+            ('chats of user', Chat.objects.using(alias).filter(participants=user_id).order_by('-last_activity_at')),
+            ('membership check', Chat.participants.through.objects.using(alias).filter(chat=chat, user_id=user_id)[:1]),
+        ]
+
+    def report(self, alias, label, queries, repeat):
+        self.stdout.write(self.style.MIGRATE_HEADING(f'\n== {label} =='))
+        for name, queryset in queries:
+            stats = measure(lambda: list(queryset.all()), repeat=repeat)
+            self.stdout.write(f'{name:<24} {format_stats(stats)}')
+            for line in queryset.explain().splitlines():
+                self.stdout.write(f'    {line}')
+
+    def drop_indexes(self, alias):
+        with connections[alias].schema_editor() as editor:
+            for index in Message._meta.indexes:
+                editor.remove_index(Message, index)
+            editor.execute(f'DROP INDEX IF EXISTS {PARTICIPANTS_INDEX}')
+        self.analyze(alias)
+
+    def create_indexes(self, alias):
+        with connections[alias].schema_editor() as editor:
+            for index in Message._meta.indexes:
+                editor.add_index(Message, index)
+            editor.execute(
+                f'CREATE INDEX {PARTICIPANTS_INDEX} ON api_chat_participants (user_id, chat_id)'
+            )
+        self.analyze(alias)
+
+    def analyze(self, alias):
+        with connections[alias].cursor() as cursor:
+            cursor.execute('ANALYZE')
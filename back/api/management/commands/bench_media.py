@@ -0,0 +1,79 @@
+import os
+import tempfile
+
+from django.core.files.base import ContentFile
+from django.core.management.base import BaseCommand
+from django.test import RequestFactory, override_settings
+from django.utils.http import http_date
+from django.views.static import serve
+
+from api.mediaserve import serve_media
+from api.storage import ContentAddressedStorage
+
+from ._bench import format_stats, measure
+
+
+def drain(response):
+    """Read the whole body like a client would and return its size"""
+    if response.streaming:
+        size = sum(len(block) for block in response.streaming_content)
+    else:
+        size = len(response.content)
+    response.close()
+    return size
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare django.views.static.serve, which used to serve media in DEBUG, "
+        "with api.mediaserve for full downloads, revalidation, seeking and offload."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--size', type=int, default=20, help='Size of the test file in MB')
+        parser.add_argument('--range', type=int, default=256, help='Size of the seek request in KB')
+        parser.add_argument('--repeat', type=int, default=30)
+
+    def handle(self, *args, **options):
+        with tempfile.TemporaryDirectory() as root, override_settings(MEDIA_ROOT=root):
+            name = ContentAddressedStorage(location=root).save(
+                'clip.mp4', ContentFile(os.urandom(options['size'] * 1024 * 1024))
+            )
+            self.run(root, name, options['range'] * 1024, options['repeat'])
+
+    def run(self, root, name, range_size, repeat):
+        factory = RequestFactory()
+        mtime = os.stat(os.path.join(root, name)).st_mtime
+        etag = serve_media(factory.get('/'), name)['ETag']
+        middle = os.path.getsize(os.path.join(root, name)) // 2
+        seek = f'bytes={middle}-{middle + range_size - 1}'
+
+        def old(**headers):
+            return serve(factory.get('/', headers=headers), name, document_root=root)
+
+        def new(**headers):
+            return serve_media(factory.get('/', headers=headers), name)
+
+        cases = [
+            ('full download', {}),
+            ('revalidate', None),
+            (f'seek {range_size // 1024} KB', {'Range': seek}),
+        ]
+        for label, headers in cases:
+            self.stdout.write(self.style.MIGRATE_HEADING(f'\n== {label} =='))
+            old_headers = headers if headers is not None else {'If-Modified-Since': http_date(mtime)}
+            new_headers = headers if headers is not None else {'If-None-Match': etag}
+            for view_label, view, view_headers in (('static', old, old_headers), ('mediaserve', new, new_headers)):
+                response = view(**view_headers)
+                self.stdout.write(
+                    f'{view_label:<12}{response.status_code}  {drain(response):>10} bytes  '
+                    f"cache-control: {response.get('Cache-Control', '-')}"
+                )
+                self.report(view_label, lambda: drain(view(**view_headers)), repeat)
+
+        self.stdout.write(self.style.MIGRATE_HEADING('\n== X-Accel-Redirect =='))
+        with override_settings(MEDIA_ACCEL_REDIRECT='/protected-media/'):
+            self.report('mediaserve', lambda: drain(new()), repeat)
+
+    def report(self, label, fn, repeat):
+        self.stdout.write(f'{label:<12}{format_stats(measure(fn, repeat=repeat))}')
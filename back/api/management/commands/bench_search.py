@@ -0,0 +1,63 @@
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from api.models import Chat, User
+from api.search import MessageSearch
+
+from ._bench import format_stats, measure, scratch_database, seed, vocabulary
+
+
+class Command(BaseCommand):
+    help = (
+        "Seed a scratch SQLite database and compare message search through the "
+        "FTS5 index with the equivalent LIKE scan over the caller's chats."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=1_000_000)
+        parser.add_argument('--chats', type=int, default=5_000)
+        parser.add_argument('--users', type=int, default=1_000)
+        parser.add_argument('--group-size', type=int, default=20)
+        parser.add_argument('--repeat', type=int, default=20)
+        parser.add_argument('--db', help='Keep the seeded database at this path and reuse it on later runs')
+
+    def handle(self, *args, **options):
+        with scratch_database(options['db']) as alias:
+            if not Chat.objects.using(alias).exists():
+                seed(alias, users=options['users'], chats=options['chats'],
+                     messages=options['messages'], group_size=options['group_size'],
+                     stdout=self.stdout)
+
+            # The member of the most chats is the most expensive caller to scope.
+            through = Chat.participants.through.objects.using(alias)
+            user_id = max(
+                set(through.values_list('user_id', flat=True)),
+                key=lambda uid: through.filter(user_id=uid).count(),
+            )
+            user = User.objects.using(alias).get(id=user_id)
+            chats = through.filter(user_id=user_id).count()
+            self.stdout.write(f'searching as user {user_id}, member of {chats} chats')
+
+            words = vocabulary()
+            queries = [
+                ('common word', words[0]),
+                ('mid-frequency word', words[len(words) // 10]),
+                ('rare word', words[-1]),
+                ('two words', f'{words[1]} {words[50]}'),
+                ('prefix', words[200][:3]),
+            ]
+            for label, text in queries:
+                search = MessageSearch(user, text, using=alias)
+                self.stdout.write(self.style.MIGRATE_HEADING(f'\n== {label}: {text!r} =='))
+                self.report('fts5', lambda: search[0:20], options['repeat'])
+                self.report('like', lambda: list(search.like_queryset()[:20]), options['repeat'])
+
+            with connections[alias].cursor() as cursor:
+                cursor.execute("SELECT SUM(pgsize) FROM dbstat WHERE name LIKE 'api_message_fts%'")
+                size = cursor.fetchone()[0] if connections[alias].vendor == 'sqlite' else None
+            if size:
+                self.stdout.write(f'\nindex size {size / 1024 / 1024:.1f} MiB')
+
+    def report(self, label, fn, repeat):
+        stats = measure(fn, repeat=repeat)
+        self.stdout.write(f'{label:<6}{format_stats(stats)}')
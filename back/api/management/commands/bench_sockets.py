@@ -0,0 +1,137 @@
+import asyncio
+import time
+
+import socketio
+from django.core.management.base import BaseCommand
+from rest_framework_simplejwt.tokens import AccessToken
+
+from api.models import Chat, User
+
+from ._bench import format_stats
+
+USERNAME_PREFIX = 'loadtest-'
+
+
+class Command(BaseCommand):
+    help = (
+        "Load test a running socket server: open many authenticated connections, "
+        "then send messages into group chats and report connection capacity and "
+        "message:created fan-out latency. Point --url at the eventlet server from "
+        "an older checkout to compare both servers against the same database."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', default='http://localhost:5000')
+        parser.add_argument('--clients', type=int, default=2000)
+        parser.add_argument('--chat-size', type=int, default=50)
+        parser.add_argument('--messages', type=int, default=20, help='Messages sent into each chat')
+        parser.add_argument('--interval', type=float, default=0.05, help='Seconds between messages per sender')
+        parser.add_argument('--concurrency', type=int, default=200, help='Handshakes in flight at once')
+        parser.add_argument('--timeout', type=float, default=30)
+
+    def handle(self, *args, **options):
+        users, chats = self.prepare(options['clients'], options['chat_size'])
+        try:
+            asyncio.run(self.run(users, chats, options))
+        finally:
+            Chat.objects.filter(id__in=[chat.id for chat, _ in chats]).delete()
+            User.objects.filter(username__startswith=USERNAME_PREFIX).delete()
+
+    def prepare(self, count, chat_size):
+        User.objects.filter(username__startswith=USERNAME_PREFIX).delete()
+        User.objects.bulk_create([
+            User(username=f'{USERNAME_PREFIX}{i}', password='!') for i in range(count)
+        ])
+        users = list(User.objects.filter(username__startswith=USERNAME_PREFIX).order_by('id'))
+
+        chats = []
+        for start in range(0, len(users), chat_size):
+            members = users[start:start + chat_size]
+            chat = Chat.objects.create(name=f'{USERNAME_PREFIX}chat', is_group=True)
+            chat.participants.set(members)
+            chats.append((chat, members))
+        return users, chats
+
+    async def run(self, users, chats, options):
+        latencies = []
+        received = {'count': 0}
+        semaphore = asyncio.Semaphore(options['concurrency'])
+
+        async def open_client(user):
+            client = socketio.AsyncClient(reconnection=False)
+            authed = asyncio.Event()
+
+            @client.on('auth_success')
+            async def on_auth(data):
+                authed.set()
+
+            @client.on('message:created')
+            async def on_message(message):
+                sent_at = float(message['text'].split(':', 1)[1])
+                latencies.append((time.perf_counter() - sent_at) * 1000)
+                received['count'] += 1
+
+            async with semaphore:
+                try:
+                    await client.connect(options['url'], transports=['websocket'],
+                                         wait_timeout=options['timeout'])
+                    await client.emit('auth', {'token': str(AccessToken.for_user(user))})
+                    await asyncio.wait_for(authed.wait(), options['timeout'])
+                except Exception:
+                    await client.disconnect()
+                    return user.id, None
+            return user.id, client
+
+        started = time.perf_counter()
+        results = await asyncio.gather(*(open_client(user) for user in users))
+        clients = {user_id: client for user_id, client in results if client}
+        elapsed = time.perf_counter() - started
+
+        self.stdout.write(self.style.MIGRATE_HEADING('== connections =='))
+        self.stdout.write(
+            f'{len(clients)}/{len(users)} authenticated in {elapsed:.2f} s '
+            f'({len(clients) / elapsed:.0f} handshakes/s)'
+        )
+
+        async def send(chat, sender):
+            for _ in range(options['messages']):
+                await sender.emit('message_create', {
+                    'token': sender.bench_token,
+                    'chat_id': chat.id,
+                    'text': f'bench:{time.perf_counter()}',
+                })
+                await asyncio.sleep(options['interval'])
+
+        senders = []
+        expected = 0
+        for chat, members in chats:
+            online = [member for member in members if member.id in clients]
+            if not online:
+                continue
+            sender = clients[online[0].id]
+            sender.bench_token = str(AccessToken.for_user(online[0]))
+            senders.append(send(chat, sender))
+            expected += options['messages'] * len(online)
+
+        started = time.perf_counter()
+        await asyncio.gather(*senders)
+        deadline = time.monotonic() + options['timeout']
+        while received['count'] < expected and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        elapsed = time.perf_counter() - started
+
+        self.stdout.write(self.style.MIGRATE_HEADING('== fan-out =='))
+        self.stdout.write(
+            f'{received["count"]}/{expected} deliveries in {elapsed:.2f} s '
+            f'({received["count"] / elapsed:.0f} deliveries/s)'
+        )
+        if latencies:
+            latencies.sort()
+            p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+            self.stdout.write(format_stats({
+                'median': latencies[len(latencies) // 2],
+                'p95': latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))],
+                'max': latencies[-1],
+            }) + f'  p99 {p99:8.3f} ms')
+
+        await asyncio.gather(*(client.disconnect() for client in clients.values()))
@@ -0,0 +1,78 @@
+import random
+
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+
+from api.models import Chat, User
+from api.search import typeahead
+
+from ._bench import format_stats, measure, scratch_database, vocabulary
+
+
+class Command(BaseCommand):
+    help = (
+        "Seed a scratch SQLite database with many users and compare the old "
+        "icontains user search with the indexed typeahead, cold and cached."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1_000_000)
+        parser.add_argument('--contacts', type=int, default=200)
+        parser.add_argument('--repeat', type=int, default=20)
+        parser.add_argument('--db', help='Keep the seeded database at this path and reuse it on later runs')
+
+    def handle(self, *args, **options):
+        with scratch_database(options['db']) as alias:
+            if not User.objects.using(alias).exists():
+                self.seed(alias, options['users'], options['contacts'])
+
+            # typeahead() reads the default database, so point it at the scratch one.
+            from django.db import connections
+            connections['default'], saved = connections[alias], connections['default']
+            try:
+                self.run(options['repeat'])
+            finally:
+                connections['default'] = saved
+
+    def seed(self, alias, count, contacts):
+        rng = random.Random(42)
+        words = vocabulary()
+        batch = []
+        for i in range(count):
+            name = f'{rng.choice(words)}{i}'
+            batch.append(User(username=name, email=f'{rng.choice(words)}.{i}@example.com', password='!'))
+            if len(batch) == 20000:
+                User.objects.using(alias).bulk_create(batch)
+                batch = []
+                self.stdout.write(f'\rseeded {i + 1}/{count} users', ending='')
+        User.objects.using(alias).bulk_create(batch)
+        self.stdout.write('')
+
+        ids = list(User.objects.using(alias).values_list('id', flat=True)[:contacts + 1])
+        chat = Chat.objects.using(alias).create(name='bench contacts', is_group=True)
+        chat.participants.through.objects.using(alias).bulk_create([
+            chat.participants.through(chat_id=chat.id, user_id=user_id) for user_id in ids
+        ])
+
+    def run(self, repeat):
+        user = User.objects.order_by('id').first()
+        prefixes = ['d', 'da', 'dan', 'dano', User.objects.order_by('-id').values_list('username', flat=True)[0][:6]]
+        for prefix in prefixes:
+            self.stdout.write(self.style.MIGRATE_HEADING(f'\n== {prefix!r} =='))
+
+            def scan():
+                return list(User.objects.filter(
+                    Q(username__icontains=prefix) | Q(email__icontains=prefix)
+                ).exclude(id=user.id)[:20])
+
+            def cold():
+                cache.clear()
+                return typeahead(user, prefix)
+
+            self.report('icontains', scan, repeat)
+            self.report('cold', cold, repeat)
+            self.report('cached', lambda: typeahead(user, prefix), repeat)
+
+    def report(self, label, fn, repeat):
+        self.stdout.write(f'{label:<10}{format_stats(measure(fn, repeat=repeat))}')
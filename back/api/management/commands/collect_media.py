@@ -0,0 +1,25 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from api import media
+
+
+class Command(BaseCommand):
+    help = "Delete stored media files and their variants that no row has referenced for the grace period."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--grace', type=int, default=None, help='Seconds a file must stay unreferenced (default MEDIA_GC_GRACE)')
+        parser.add_argument('--recount', action='store_true', help='Rebuild the reference counts from the tables first')
+        parser.add_argument('--loop', type=int, default=0, metavar='SECONDS', help='Keep running, collecting every SECONDS')
+
+    def handle(self, *args, **options):
+        if options['recount']:
+            counts = media.recount()
+            self.stdout.write(f'{len(counts)} referenced files')
+        while True:
+            collected = media.collect_garbage(grace=options['grace'])
+            self.stdout.write(f'{collected} files removed')
+            if not options['loop']:
+                break
+            time.sleep(options['loop'])
@@ -0,0 +1,25 @@
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+
+from api import thumbnails
+
+
+class Command(BaseCommand):
+    help = "Generate missing or stale image variants for avatars, message images and gallery images."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--force', action='store_true', help='Render variants again even if they exist')
+
+    def handle(self, *args, **options):
+        for model, (field, variants_field) in thumbnails.IMAGE_FIELDS.items():
+            rows = model.objects.exclude(**{field: ''}).exclude(**{f'{field}__isnull': True})
+            done = 0
+            for pk, name, variants in rows.values_list('pk', field, variants_field).iterator():
+                if not options['force'] and (variants or {}).get('source') == name:
+                    continue
+                if options['force']:
+                    for variant in thumbnails.variant_names(variants):
+                        default_storage.delete(variant)
+                thumbnails.process(model, pk, name)
+                done += 1
+            self.stdout.write(f'{model.__name__}.{field}: {done} processed')
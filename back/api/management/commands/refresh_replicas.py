@@ -0,0 +1,39 @@
+import sqlite3
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+
+class Command(BaseCommand):
+    help = (
+        "Copy the SQLite database into the SQLite stand-ins listed in DATABASE_REPLICA_URLS, "
+        "to try replica routing locally. With --loop the copies lag the primary like real replicas."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--loop', type=float, default=0, metavar='SECONDS', help='Keep running, copying every SECONDS')
+
+    def handle(self, *args, **options):
+        if connections['default'].vendor != 'sqlite':
+            raise CommandError('Only SQLite databases can be copied; real replicas replicate themselves.')
+        aliases = [alias for alias in settings.DATABASE_REPLICAS if connections[alias].vendor == 'sqlite']
+        if not aliases:
+            raise CommandError('DATABASE_REPLICA_URLS lists no sqlite:/// stand-ins.')
+
+        while True:
+            source = sqlite3.connect(settings.DATABASES['default']['NAME'])
+            try:
+                for alias in aliases:
+                    target = sqlite3.connect(settings.DATABASES[alias]['NAME'])
+                    try:
+                        source.backup(target)
+                    finally:
+                        target.close()
+            finally:
+                source.close()
+            self.stdout.write(f"copied to {', '.join(aliases)}")
+            if not options['loop']:
+                break
+            time.sleep(options['loop'])
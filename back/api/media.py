@@ -0,0 +1,128 @@
+"""Reference counts and garbage collection for content-addressed media.
+
+Each stored name has a ``Blob`` row counting the rows that point at it,
+kept up to date by signals. When the count drops to zero the blob is only
+marked; ``collect_garbage`` deletes it together with its image variants once
+it has stayed unreferenced for ``settings.MEDIA_GC_GRACE`` seconds, so a file
+that is referenced again straight away (the same avatar uploaded twice)
+survives. ``recount`` rebuilds the counters from the tables after bulk
+changes that bypass signals.
+"""
+import os
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from . import uploads
+from .models import Blob, Image, Message, MessageArchive, Upload, User
+from .storage import get_media_storage
+from .thumbnails import variant_directory
+
+# (model, file field) pairs whose files are counted
+REFERENCING_FIELDS = [(User, 'avatar'), (Message, 'image'), (Image, 'image'), (Upload, 'file')]
+
+
+def incref(name):
+    if not name:
+        return
+    Blob.objects.bulk_create([Blob(name=name)], ignore_conflicts=True)
+    Blob.objects.filter(name=name).update(refcount=F('refcount') + 1, unreferenced_at=None)
+
+
+def decref(name):
+    if not name:
+        return
+    Blob.objects.filter(name=name, refcount__gt=0).update(refcount=F('refcount') - 1)
+    Blob.objects.filter(name=name, refcount=0, unreferenced_at__isnull=True).update(
+        unreferenced_at=timezone.now()
+    )
+
+
+def delete_file(name):
+    """Delete a stored file and every image variant made from it"""
+    get_media_storage().delete(name)
+    directory = variant_directory(name)
+    if default_storage.exists(directory):
+        for variant in default_storage.listdir(directory)[1]:
+            default_storage.delete(f'{directory}/{variant}')
+        # FileSystemStorage removes the emptied directory as well.
+        default_storage.delete(directory)
+
+
+def delete_unless_saved(name, since):
+    """Delete a stored file and its variants unless its bytes were saved again after since.
+
+    The file is moved aside before its time is checked, so a save of the same
+    bytes either touched it first and keeps it, or finds it gone and writes a
+    new copy. Returns whether it was deleted.
+    """
+    path = get_media_storage().path(name)
+    aside = f'{path}.gc'
+    try:
+        os.rename(path, aside)
+    except FileNotFoundError:
+        delete_file(name)
+        return True
+    if os.stat(aside).st_mtime >= since.timestamp():
+        os.replace(aside, path)
+        return False
+    os.remove(aside)
+    delete_file(name)
+    return True
+
+
+def collect_garbage(grace=None, limit=1000):
+    """Delete blobs nobody has referenced for grace seconds and return how many went"""
+    grace = settings.MEDIA_GC_GRACE if grace is None else grace
+    now = timezone.now()
+
+    # Chunked uploads nobody finished or attached give their files back too.
+    stale = Upload.objects.filter(updated_at__lt=now - timedelta(seconds=settings.UPLOAD_EXPIRY))
+    for upload in stale[:limit]:
+        uploads.discard(upload)
+
+    collected = 0
+    unreferenced = Blob.objects.filter(refcount=0, unreferenced_at__lt=now - timedelta(seconds=grace))
+    for name in list(unreferenced.values_list('name', flat=True)[:limit]):
+        with transaction.atomic():
+            # The lock holds back increfs until the file and its row are gone
+            # together; a blob referenced again meanwhile stays.
+            blob = unreferenced.select_for_update().filter(name=name).first()
+            if blob is None:
+                continue
+            try:
+                deleted = delete_unless_saved(name, blob.unreferenced_at)
+            except OSError as e:
+                print(f"Error removing media file {name}: {e}")
+                continue
+            if not deleted:
+                # Saved again but not referenced yet: give it another grace period.
+                Blob.objects.filter(pk=blob.pk).update(unreferenced_at=now)
+                continue
+            blob.delete()
+        collected += 1
+    return collected
+
+
+def recount():
+    """Rebuild every Blob counter from the rows that reference files"""
+    counts = {}
+    for model, field in REFERENCING_FIELDS:
+        rows = model.objects.exclude(**{field: ''}).exclude(**{f'{field}__isnull': True})
+        for name in rows.values_list(field, flat=True).iterator():
+            counts[name] = counts.get(name, 0) + 1
+    for names in MessageArchive.objects.values_list('images', flat=True).iterator():
+        for name in names:
+            counts[name] = counts.get(name, 0) + 1
+
+    with transaction.atomic():
+        Blob.objects.update(refcount=0)
+        Blob.objects.bulk_create([Blob(name=name) for name in counts], ignore_conflicts=True)
+        for name, count in counts.items():
+            Blob.objects.filter(name=name).update(refcount=count, unreferenced_at=None)
+        Blob.objects.filter(refcount=0, unreferenced_at__isnull=True).update(unreferenced_at=timezone.now())
+    return counts
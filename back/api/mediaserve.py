@@ -0,0 +1,164 @@
+"""Serving stored media files over HTTP.
+
+Content-addressed files and their variants never change once written
+(``api.storage``), so they go out with a year-long ``immutable``
+Cache-Control and their hash as a strong ETag; browsers and CDNs never ask
+again. Other files under MEDIA_ROOT get a short max-age and an ETag built
+from their mtime and size. Conditional requests are answered with 304/412
+and single byte ranges with 206, which lets players seek in video and
+clients resume interrupted downloads.
+
+With ``settings.MEDIA_ACCEL_REDIRECT`` set, only the headers are built here
+and the body is left to nginx through ``X-Accel-Redirect``;
+``settings.MEDIA_X_SENDFILE`` does the same for Apache/lighttpd. The front
+server then handles ranges itself.
+"""
+import mimetypes
+import os
+import posixpath
+import re
+from urllib.parse import quote
+
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.http import FileResponse, Http404, HttpResponse, StreamingHttpResponse
+from django.utils._os import safe_join
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, parse_http_date_safe
+from django.views.decorators.http import require_safe
+
+IMMUTABLE_PREFIXES = ('cas/', 'variants/cas/')
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+CAS_DIGEST = re.compile(r'^(?:variants/)?cas/[0-9a-f]{2}/[0-9a-f]{2}/([0-9a-f]{64})')
+RANGE = re.compile(r'^bytes=(\d*)-(\d*)$')
+BLOCK_SIZE = 64 * 1024
+
+
+def etag_for(path, stat):
+    match = CAS_DIGEST.match(path)
+    if match and not path.startswith('variants/'):
+        return f'"{match.group(1)}"'
+    if match:
+        # Variants are fixed per source and size/format.
+        return f'"{match.group(1)}-{posixpath.basename(path)}"'
+    return f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+
+
+def parse_range(header, size):
+    """(start, end) inclusive for a single satisfiable range, None to serve
+    everything, or False when the range cannot be satisfied"""
+    match = RANGE.match(header.replace(' ', ''))
+    if not match or match.groups() == ('', ''):
+        # Multiple or malformed ranges; answering with the whole file is allowed.
+        return None
+    first, last = match.groups()
+    if first == '':
+        length = int(last)
+        if length == 0:
+            return False
+        return max(size - length, 0), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or start > end:
+        return False
+    return start, end
+
+
+def if_range_matches(request, etag, last_modified):
+    value = request.headers.get('If-Range')
+    if not value:
+        return True
+    if value.startswith('"') or value.startswith('W/'):
+        return value == etag
+    return parse_http_date_safe(value) == last_modified
+
+
+def read_range(path, start, length):
+    with open(path, 'rb') as f:
+        f.seek(start)
+        while length > 0:
+            data = f.read(min(BLOCK_SIZE, length))
+            if not data:
+                break
+            length -= len(data)
+            yield data
+
+
+def set_headers(response, headers):
+    for header, value in headers.items():
+        response[header] = value
+
+
+def offload(response, path, full_path):
+    """Hand the body to the front server; True if one is configured"""
+    # Both headers are unquoted by the front server, and names may hold
+    # spaces or characters a header cannot carry as they are.
+    if settings.MEDIA_ACCEL_REDIRECT:
+        response['X-Accel-Redirect'] = settings.MEDIA_ACCEL_REDIRECT.rstrip('/') + '/' + quote(path)
+        return True
+    if settings.MEDIA_X_SENDFILE:
+        response['X-Sendfile'] = quote(full_path)
+        return True
+    return False
+
+
+@require_safe
+def serve_media(request, path):
+    """Serve a file under MEDIA_ROOT with caching, conditional and range support"""
+    path = posixpath.normpath(path).lstrip('/')
+    try:
+        full_path = safe_join(settings.MEDIA_ROOT, path)
+        stat = os.stat(full_path)
+    except (OSError, ValueError, SuspiciousFileOperation):
+        raise Http404('File not found')
+    if not os.path.isfile(full_path) or posixpath.basename(path).startswith('.'):
+        raise Http404('File not found')
+
+    etag = etag_for(path, stat)
+    last_modified = int(stat.st_mtime)
+    content_type = mimetypes.guess_type(full_path)[0] or 'application/octet-stream'
+    headers = {
+        'ETag': etag,
+        'Last-Modified': http_date(last_modified),
+        'Cache-Control': (
+            IMMUTABLE_CACHE_CONTROL if path.startswith(IMMUTABLE_PREFIXES)
+            else f'public, max-age={settings.MEDIA_CACHE_MAX_AGE}'
+        ),
+        'Accept-Ranges': 'bytes',
+        'X-Content-Type-Options': 'nosniff',
+    }
+
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is not None:
+        set_headers(response, headers)
+        return response
+
+    size = stat.st_size
+    byte_range = None
+    if 'Range' in request.headers and if_range_matches(request, etag, last_modified):
+        byte_range = parse_range(request.headers['Range'], size)
+    if byte_range is False:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = f'bytes */{size}'
+        return response
+
+    response = HttpResponse(content_type=content_type)
+    if offload(response, path, full_path):
+        # The front server fills in length and ranges from the file itself.
+        set_headers(response, headers)
+        return response
+    if request.method == 'GET' and byte_range:
+        start, end = byte_range
+        response = StreamingHttpResponse(read_range(full_path, start, end - start + 1), content_type=content_type)
+    elif request.method == 'GET':
+        response = FileResponse(open(full_path, 'rb'), content_type=content_type)
+
+    set_headers(response, headers)
+    if byte_range:
+        start, end = byte_range
+        response.status_code = 206
+        response['Content-Range'] = f'bytes {start}-{end}/{size}'
+        response['Content-Length'] = str(end - start + 1)
+    else:
+        response['Content-Length'] = str(size)
+    return response
@@ -0,0 +1,70 @@
+# Generated by Django 5.2 on 2026-10-18 10:16
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def backfill(apps, schema_editor):
+    Chat = apps.get_model('api', 'Chat')
+    ChatReadState = apps.get_model('api', 'ChatReadState')
+    Message = apps.get_model('api', 'Message')
+    db_alias = schema_editor.connection.alias
+
+    for chat in Chat.objects.using(db_alias).iterator():
+        last_message = Message.objects.using(db_alias).filter(chat=chat).order_by('-sent_at', '-id').first()
+        chat.last_message = last_message
+        chat.last_activity_at = last_message.sent_at if last_message else chat.created_at
+        chat.save(update_fields=['last_message', 'last_activity_at'])
+
+        unread = (
+            Message.objects.using(db_alias).filter(chat=chat, is_read=False)
+            .values('sender_id')
+            .annotate(count=Count('id'))
+        )
+        unread_by_sender = {row['sender_id']: row['count'] for row in unread}
+        total_unread = sum(unread_by_sender.values())
+        ChatReadState.objects.using(db_alias).bulk_create([
+            ChatReadState(
+                chat=chat,
+                user=user,
+                unread_count=total_unread - unread_by_sender.get(user.id, 0),
+            )
+            for user in chat.participants.all()
+        ], ignore_conflicts=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0002_alter_message_options_user_last_active'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chat',
+            name='last_activity_at',
+            field=models.DateTimeField(db_index=True, default=django.utils.timezone.now),
+        ),
+        migrations.AddField(
+            model_name='chat',
+            name='last_message',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='api.message'),
+        ),
+        migrations.CreateModel(
+            name='ChatReadState',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('unread_count', models.PositiveIntegerField(default=0)),
+                ('chat', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='read_states', to='api.chat')),
+                ('last_read_message', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='api.message')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='read_states', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('chat', 'user'), name='unique_chat_read_state')],
+            },
+        ),
+        migrations.RunPython(backfill, migrations.RunPython.noop),
+    ]
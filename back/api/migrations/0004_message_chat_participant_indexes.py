@@ -0,0 +1,23 @@
+# Generated by Django 5.2 on 2026-10-18 10:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0003_chat_last_message_read_state'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['chat', 'sent_at', 'id'], name='message_chat_sent_idx'),
+        ),
+        # The implicit Chat.participants table only has (chat_id, user_id);
+        # "chats of user X" needs the reverse order to stay index-only.
+        migrations.RunSQL(
+            'CREATE INDEX api_chat_participants_user_chat_idx ON api_chat_participants (user_id, chat_id)',
+            'DROP INDEX api_chat_participants_user_chat_idx',
+        ),
+    ]
@@ -0,0 +1,64 @@
+from django.db import migrations
+
+# An external-content FTS5 table: it stores only the inverted index and reads
+# message text back from api_message. Triggers keep it in step with every
+# write, bulk_create and raw SQL included. The prefix indexes serve the
+# search-as-you-type prefix match on the last word.
+CREATE_INDEX = [
+    """
+    CREATE VIRTUAL TABLE api_message_fts USING fts5(
+        text, content='api_message', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2', prefix='2 3 4'
+    )
+    """,
+    """
+    CREATE TRIGGER api_message_fts_insert AFTER INSERT ON api_message BEGIN
+        INSERT INTO api_message_fts (rowid, text) VALUES (new.id, new.text);
+    END
+    """,
+    """
+    CREATE TRIGGER api_message_fts_delete AFTER DELETE ON api_message BEGIN
+        INSERT INTO api_message_fts (api_message_fts, rowid, text) VALUES ('delete', old.id, old.text);
+    END
+    """,
+    """
+    CREATE TRIGGER api_message_fts_update AFTER UPDATE OF text ON api_message BEGIN
+        INSERT INTO api_message_fts (api_message_fts, rowid, text) VALUES ('delete', old.id, old.text);
+        INSERT INTO api_message_fts (rowid, text) VALUES (new.id, new.text);
+    END
+    """,
+    "INSERT INTO api_message_fts (api_message_fts) VALUES ('rebuild')",
+]
+
+DROP_INDEX = [
+    'DROP TRIGGER IF EXISTS api_message_fts_insert',
+    'DROP TRIGGER IF EXISTS api_message_fts_delete',
+    'DROP TRIGGER IF EXISTS api_message_fts_update',
+    'DROP TABLE IF EXISTS api_message_fts',
+]
+
+
+def create_search_index(apps, schema_editor):
+    # Only SQLite has FTS5; api.search falls back to LIKE elsewhere.
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    for statement in CREATE_INDEX:
+        schema_editor.execute(statement)
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    for statement in DROP_INDEX:
+        schema_editor.execute(statement)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0004_message_chat_participant_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
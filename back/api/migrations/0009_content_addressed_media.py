@@ -0,0 +1,74 @@
+# Generated by Django 5.2 on 2026-10-18 10:52
+
+from importlib import import_module
+
+import api.storage
+from django.db import migrations, models
+
+search_index = import_module('api.migrations.0005_message_search_index')
+
+
+def recreate_search_triggers(apps, schema_editor):
+    # SQLite rebuilds api_message to alter Message.image, which drops the
+    # triggers that keep the search index in step. The rowids survive, so
+    # the index itself is still valid.
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    for statement in search_index.CREATE_INDEX:
+        if 'CREATE TRIGGER' in statement:
+            schema_editor.execute(statement.replace('CREATE TRIGGER', 'CREATE TRIGGER IF NOT EXISTS'))
+
+
+def count_existing_files(apps, schema_editor):
+    """Start every file already stored with the number of rows that use it"""
+    db_alias = schema_editor.connection.alias
+    Blob = apps.get_model('api', 'Blob')
+    counts = {}
+    for model, field in (('User', 'avatar'), ('Message', 'image'), ('Image', 'image'), ('Upload', 'file')):
+        rows = apps.get_model('api', model).objects.using(db_alias).exclude(**{field: ''})
+        for name in rows.exclude(**{f'{field}__isnull': True}).values_list(field, flat=True).iterator():
+            counts[name] = counts.get(name, 0) + 1
+    Blob.objects.using(db_alias).bulk_create(
+        [Blob(name=name, refcount=count) for name, count in counts.items()], batch_size=1000
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0008_upload'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Blob',
+            fields=[
+                ('name', models.CharField(max_length=255, primary_key=True, serialize=False)),
+                ('refcount', models.PositiveIntegerField(default=0)),
+                ('unreferenced_at', models.DateTimeField(blank=True, db_index=True, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AlterField(
+            model_name='image',
+            name='image',
+            field=models.ImageField(storage=api.storage.get_media_storage, upload_to='user_images/'),
+        ),
+        migrations.AlterField(
+            model_name='message',
+            name='image',
+            field=models.ImageField(blank=True, null=True, storage=api.storage.get_media_storage, upload_to='messages/'),
+        ),
+        migrations.AlterField(
+            model_name='upload',
+            name='file',
+            field=models.FileField(blank=True, storage=api.storage.get_media_storage, upload_to='uploads/'),
+        ),
+        migrations.AlterField(
+            model_name='user',
+            name='avatar',
+            field=models.ImageField(blank=True, null=True, storage=api.storage.get_media_storage, upload_to='avatars/'),
+        ),
+        migrations.RunPython(recreate_search_triggers, migrations.RunPython.noop),
+        migrations.RunPython(count_existing_files, migrations.RunPython.noop),
+    ]
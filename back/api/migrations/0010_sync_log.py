@@ -0,0 +1,27 @@
+# Generated by Django 5.2 on 2026-10-18 11:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0009_content_addressed_media'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Change',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('chat_id', models.BigIntegerField()),
+                ('user_id', models.BigIntegerField(blank=True, null=True)),
+                ('kind', models.CharField(choices=[('message', 'Message created or edited'), ('message_deleted', 'Message deleted'), ('chat', 'Chat changed'), ('left', 'Left the chat')], max_length=20)),
+                ('message_id', models.BigIntegerField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True, db_index=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['chat_id', 'id'], name='change_chat_idx'), models.Index(fields=['user_id', 'id'], name='change_user_idx')],
+            },
+        ),
+    ]
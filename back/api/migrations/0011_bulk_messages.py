@@ -0,0 +1,30 @@
+# Generated by Django 5.2 on 2026-10-18 11:02
+
+from importlib import import_module
+
+import django.utils.timezone
+from django.db import migrations, models
+
+# The alter rebuilds api_message on SQLite; put the search triggers back.
+recreate_search_triggers = import_module('api.migrations.0009_content_addressed_media').recreate_search_triggers
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0010_sync_log'),
+    ]
+
+    operations = [
+        migrations.RunPython(migrations.RunPython.noop, recreate_search_triggers),
+        migrations.AlterField(
+            model_name='message',
+            name='sent_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.RunPython(recreate_search_triggers, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(condition=models.Q(('is_read', False)), fields=['chat', 'id'], name='message_unread_idx'),
+        ),
+    ]
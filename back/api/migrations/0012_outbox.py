@@ -0,0 +1,29 @@
+# Generated by Django 5.2 on 2026-10-18 11:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0011_bulk_messages'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OutboxEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('event', models.CharField(max_length=50)),
+                ('room', models.CharField(max_length=100)),
+                ('payload', models.JSONField()),
+                ('shard', models.PositiveSmallIntegerField()),
+                ('claimed_by', models.CharField(blank=True, max_length=32)),
+                ('claimed_until', models.DateTimeField(blank=True, db_index=True, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['shard', 'id'], name='outbox_shard_idx'), models.Index(fields=['claimed_by'], name='outbox_claim_idx')],
+            },
+        ),
+    ]
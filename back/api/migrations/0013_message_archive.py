@@ -0,0 +1,37 @@
+# Generated by Django 5.2 on 2026-10-18 11:16
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0012_outbox'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MessageArchive',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('first_sent_at', models.DateTimeField()),
+                ('first_message_id', models.BigIntegerField()),
+                ('last_sent_at', models.DateTimeField()),
+                ('last_message_id', models.BigIntegerField()),
+                ('min_id', models.BigIntegerField()),
+                ('max_id', models.BigIntegerField()),
+                ('count', models.PositiveIntegerField()),
+                ('images', models.JSONField(default=list)),
+                ('data', models.BinaryField()),
+                ('chat', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='archives', to='api.chat')),
+            ],
+            options={
+                'indexes': [
+                    models.Index(fields=['chat', 'last_sent_at', 'last_message_id'], name='archive_chat_last_idx'),
+                    models.Index(fields=['chat', 'first_sent_at', 'first_message_id'], name='archive_chat_first_idx'),
+                    models.Index(fields=['chat', 'min_id'], name='archive_chat_min_id_idx'),
+                ],
+            },
+        ),
+    ]
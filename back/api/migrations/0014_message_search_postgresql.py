@@ -0,0 +1,33 @@
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVector
+from django.db import migrations
+
+# A GIN index over the tsvector expression api.search.search_vector() matches
+# on, so PostgreSQL finds matching messages without reading every row.
+INDEX = GinIndex(SearchVector('text', config='simple'), name='message_text_search_idx')
+
+
+def create_search_index(apps, schema_editor):
+    # SQLite searches through FTS5 (migration 0005) instead.
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    Message = apps.get_model('api', 'Message')
+    schema_editor.add_index(Message, INDEX)
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    Message = apps.get_model('api', 'Message')
+    schema_editor.remove_index(Message, INDEX)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0013_message_archive'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
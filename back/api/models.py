@@ -1,23 +1,68 @@
+import uuid
+
 from django.contrib.auth.models import AbstractUser
-from django.db import models
+from django.db import models, transaction
+from django.db.models import F
+from django.db.models.functions import Lower
 from django.utils import timezone
 
+from .profiles import PROFILE, invalidate_profiles
+from .storage import get_media_storage
+
 
 class User(AbstractUser):
     bio = models.TextField(blank=True)
-    avatar = models.ImageField(upload_to='avatars/', null=True, blank=True)
+    avatar = models.ImageField(upload_to='avatars/', storage=get_media_storage, null=True, blank=True)
+    avatar_variants = models.JSONField(null=True, blank=True, editable=False)
     is_online = models.BooleanField(default=False)
     last_active = models.DateTimeField(default=timezone.now)
 
+    class Meta(AbstractUser.Meta):
+        # Case-insensitive prefix ranges for the user typeahead.
+        indexes = [
+            models.Index(Lower('username'), name='user_username_lower_idx'),
+            models.Index(Lower('email'), name='user_email_lower_idx'),
+        ]
+
     def __str__(self):
         return self.username
     
     def update_online_status(self, status=True):
         """Update user online status and last active time"""
         self.is_online = status
-        if status:
-            self.last_active = timezone.now()
-        self.save(update_fields=['is_online', 'last_active'])
+        self.last_active = timezone.now()
+        User.save_presence({self.pk: status})
+
+    @classmethod
+    def save_presence(cls, changes, active_ids=()):
+        """Write a batch of {user_id: is_online} changes plus activity in at most four queries.
+
+        Only statuses that differ from the stored one, which every socket node
+        shares, are written; users whose status is already right just count as
+        active. Returns the changes written.
+        """
+        now = timezone.now()
+        active_ids = set(active_ids)
+
+        if changes:
+            stored = dict(cls.objects.filter(id__in=changes).values_list('id', 'is_online'))
+            unchanged = {user_id for user_id, is_online in changes.items() if stored.get(user_id) == is_online}
+            changes = {user_id: is_online for user_id, is_online in changes.items() if user_id not in unchanged}
+            active_ids |= unchanged
+        online_ids = [user_id for user_id, is_online in changes.items() if is_online]
+        offline_ids = [user_id for user_id, is_online in changes.items() if not is_online]
+        active_ids -= set(changes)
+
+        with transaction.atomic():
+            if online_ids:
+                cls.objects.filter(id__in=online_ids).update(is_online=True, last_active=now)
+            if offline_ids:
+                cls.objects.filter(id__in=offline_ids).update(is_online=False, last_active=now)
+            if active_ids:
+                cls.objects.filter(id__in=active_ids).update(last_active=now)
+        invalidate_profiles(changes)
+        invalidate_profiles(active_ids, kinds=(PROFILE,))
+        return changes
 
 
 class Chat(models.Model):
@@ -25,9 +70,90 @@ class Chat(models.Model):
     participants = models.ManyToManyField(User, related_name='chats')
     is_group = models.BooleanField(default=False)
     created_at = models.DateTimeField(auto_now_add=True)
+    last_message = models.ForeignKey(
+        'Message', on_delete=models.SET_NULL, null=True, blank=True, related_name='+'
+    )
+    last_activity_at = models.DateTimeField(default=timezone.now, db_index=True)
 
     def __str__(self):
         return self.name if self.name else f"Chat {self.pk}"
+
+    def record_message(self, message):
+        """Point the chat at its newest message and bump the other participants' unread counters.
+
+        A message that a concurrent send has already overtaken still counts as
+        unread, but leaves the chat and the sender's cursor at the newer one.
+        """
+        with transaction.atomic():
+            last = Chat.objects.select_for_update().filter(pk=self.pk).values_list(
+                'last_message__sent_at', 'last_message_id'
+            ).get()
+            newest = last[1] is None or message.position > last
+            ChatReadState.objects.filter(chat=self).exclude(user_id=message.sender_id).update(
+                unread_count=F('unread_count') + 1
+            )
+            if newest:
+                Chat.objects.filter(pk=self.pk).update(
+                    last_message=message, last_activity_at=message.sent_at
+                )
+                ChatReadState.objects.filter(chat=self, user_id=message.sender_id).update(
+                    last_read_message=message, unread_count=0
+                )
+        if newest:
+            self.last_message = message
+            self.last_activity_at = message.sent_at
+
+    def forget_message(self, message, cursor_user_ids, unread_user_ids):
+        """Undo record_message for a deleted message.
+
+        The chat and the cursors of cursor_user_ids, which pointed at it, move
+        back to the newest message before it; unread_user_ids, who had not read
+        it yet, count one unread message less.
+        """
+        previous = Message.objects.filter(Message.up_to(message), chat_id=self.pk).order_by('-sent_at', '-id').first()
+        with transaction.atomic():
+            if previous is not None:
+                Chat.objects.filter(pk=self.pk, last_message__isnull=True).update(
+                    last_message=previous, last_activity_at=previous.sent_at
+                )
+            if cursor_user_ids:
+                ChatReadState.objects.filter(chat=self, user_id__in=cursor_user_ids).update(last_read_message=previous)
+            if unread_user_ids:
+                ChatReadState.objects.filter(chat=self, user_id__in=unread_user_ids, unread_count__gt=0).update(
+                    unread_count=F('unread_count') - 1
+                )
+
+    def record_messages(self, messages):
+        """record_message for a batch in oldest-first order, in a constant number of UPDATEs per sender.
+
+        Cursors and counters end up as if each message had been recorded in
+        turn. Imported history older than the chat's last message leaves the
+        chat, the cursors and the counters as they were.
+        """
+        with transaction.atomic():
+            last = Chat.objects.select_for_update().filter(pk=self.pk).values_list(
+                'last_message__sent_at', 'last_message_id'
+            ).get()
+            if last[1] is not None:
+                messages = [message for message in messages if message.position > last]
+            if not messages:
+                return
+            newest = messages[-1]
+            last_sent = {}
+            for index, message in enumerate(messages):
+                last_sent[message.sender_id] = index
+
+            Chat.objects.filter(pk=self.pk).update(last_message=newest, last_activity_at=newest.sent_at)
+            ChatReadState.objects.filter(chat=self).exclude(user_id__in=last_sent).update(
+                unread_count=F('unread_count') + len(messages)
+            )
+            for sender_id, index in last_sent.items():
+                unread = sum(1 for message in messages[index + 1:] if message.sender_id != sender_id)
+                ChatReadState.objects.filter(chat=self, user_id=sender_id).update(
+                    last_read_message=messages[index], unread_count=unread
+                )
+        self.last_message = newest
+        self.last_activity_at = newest.sent_at
     
     def get_other_participant(self, user):
         """Get the other participant in a 1-to-1 chat"""
@@ -41,22 +167,195 @@ class Message(models.Model):
     sender = models.ForeignKey(User, on_delete=models.CASCADE, related_name='messages')
     chat = models.ForeignKey(Chat, on_delete=models.CASCADE, related_name='messages')
     text = models.TextField(blank=True)
-    image = models.ImageField(upload_to='messages/', null=True, blank=True)
-    sent_at = models.DateTimeField(auto_now_add=True)
+    image = models.ImageField(upload_to='messages/', storage=get_media_storage, null=True, blank=True)
+    image_variants = models.JSONField(null=True, blank=True, editable=False)
+    # A default rather than auto_now_add, so imported history keeps its timestamps.
+    sent_at = models.DateTimeField(default=timezone.now)
     is_read = models.BooleanField(default=False)
 
     def __str__(self):
         return f"{self.sender.username}: {self.text[:30]}"
+
+    @property
+    def position(self):
+        """Place in the chat's history, which is ordered by (sent_at, id)"""
+        return self.sent_at, self.id
+
+    @staticmethod
+    def after(message):
+        """Messages later in history than message"""
+        return models.Q(sent_at__gte=message.sent_at) & (
+            models.Q(sent_at__gt=message.sent_at) | models.Q(id__gt=message.id)
+        )
+
+    @staticmethod
+    def up_to(message):
+        """Messages no later in history than message, message included"""
+        return models.Q(sent_at__lte=message.sent_at) & (
+            models.Q(sent_at__lt=message.sent_at) | models.Q(id__lte=message.id)
+        )
     
     class Meta:
         ordering = ['sent_at']
+        indexes = [
+            models.Index(fields=['chat', 'sent_at', 'id'], name='message_chat_sent_idx'),
+            # Only unread messages, so marking a chat read touches just those.
+            models.Index(fields=['chat', 'id'], condition=models.Q(is_read=False), name='message_unread_idx'),
+        ]
+
+
+class MessageArchive(models.Model):
+    """A run of one chat's archived messages in history order, compressed (see api.archive)"""
+    chat = models.ForeignKey(Chat, on_delete=models.CASCADE, related_name='archives')
+    # (sent_at, id) of the first and last message, the range the chunk covers.
+    first_sent_at = models.DateTimeField()
+    first_message_id = models.BigIntegerField()
+    last_sent_at = models.DateTimeField()
+    last_message_id = models.BigIntegerField()
+    # Lowest and highest message id, to find a message by id.
+    min_id = models.BigIntegerField()
+    max_id = models.BigIntegerField()
+    count = models.PositiveIntegerField()
+    # Media file of every message that has one, so they stay counted (api.media).
+    images = models.JSONField(default=list)
+    data = models.BinaryField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['chat', 'last_sent_at', 'last_message_id'], name='archive_chat_last_idx'),
+            models.Index(fields=['chat', 'first_sent_at', 'first_message_id'], name='archive_chat_first_idx'),
+            models.Index(fields=['chat', 'min_id'], name='archive_chat_min_id_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.count} messages of chat {self.chat_id} up to {self.last_sent_at:%Y-%m-%d}"
 
 
 class Image(models.Model):
     uploader = models.ForeignKey(User, on_delete=models.CASCADE, related_name='images')
-    image = models.ImageField(upload_to='user_images/')
+    image = models.ImageField(upload_to='user_images/', storage=get_media_storage)
+    image_variants = models.JSONField(null=True, blank=True, editable=False)
     caption = models.CharField(max_length=255, blank=True)
     uploaded_at = models.DateTimeField(auto_now_add=True)
 
     def __str__(self):
-        return f"Image by {self.uploader.username}"
\ No newline at end of file
+        return f"Image by {self.uploader.username}"
+
+
+class Upload(models.Model):
+    """A file sent in chunks; the bytes live under UPLOAD_TEMP_DIR until it is complete"""
+    PENDING = 'pending'
+    COMPLETE = 'complete'
+    STATUS_CHOICES = [(PENDING, 'Pending'), (COMPLETE, 'Complete')]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    owner = models.ForeignKey(User, on_delete=models.CASCADE, related_name='uploads')
+    filename = models.CharField(max_length=255)
+    size = models.PositiveBigIntegerField()
+    sha256 = models.CharField(max_length=64)
+    received = models.PositiveBigIntegerField(default=0)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING)
+    file = models.FileField(upload_to='uploads/', storage=get_media_storage, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.filename} ({self.received}/{self.size})"
+
+
+class Blob(models.Model):
+    """How many rows point at a content-addressed media file (see api.media)"""
+    name = models.CharField(max_length=255, primary_key=True)
+    refcount = models.PositiveIntegerField(default=0)
+    unreferenced_at = models.DateTimeField(null=True, blank=True, db_index=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.name} ({self.refcount} references)"
+
+
+class Change(models.Model):
+    """One entry in the sync log that reconnecting clients replay (see api.sync).
+
+    Entries without a user concern every participant of the chat; entries
+    with one concern only that user (joining, leaving, reading).
+    """
+    MESSAGE = 'message'
+    MESSAGE_DELETED = 'message_deleted'
+    CHAT = 'chat'
+    LEFT = 'left'
+    KIND_CHOICES = [
+        (MESSAGE, 'Message created or edited'),
+        (MESSAGE_DELETED, 'Message deleted'),
+        (CHAT, 'Chat changed'),
+        (LEFT, 'Left the chat'),
+    ]
+
+    chat_id = models.BigIntegerField()
+    user_id = models.BigIntegerField(null=True, blank=True)
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES)
+    message_id = models.BigIntegerField(null=True, blank=True)
+    # Writing transaction on PostgreSQL, which orders the log there.
+    txid = models.BigIntegerField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['chat_id', 'id'], name='change_chat_idx'),
+            models.Index(fields=['user_id', 'id'], name='change_user_idx'),
+            models.Index(fields=['txid', 'id'], name='change_txid_idx'),
+        ]
+
+    def __str__(self):
+        return f"#{self.pk} {self.kind} in chat {self.chat_id}"
+
+
+class OutboxEvent(models.Model):
+    """A socket event written with the change it announces, waiting for a dispatcher (see api.outbox)"""
+    event = models.CharField(max_length=50)
+    room = models.CharField(max_length=100)
+    payload = models.JSONField()
+    shard = models.PositiveSmallIntegerField()
+    claimed_by = models.CharField(max_length=32, blank=True)
+    claimed_until = models.DateTimeField(null=True, blank=True, db_index=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['shard', 'id'], name='outbox_shard_idx'),
+            models.Index(fields=['claimed_by'], name='outbox_claim_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.event} to {self.room}"
+
+
+class ChatReadState(models.Model):
+    """Per-participant read cursor for a chat"""
+    chat = models.ForeignKey(Chat, on_delete=models.CASCADE, related_name='read_states')
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='read_states')
+    last_read_message = models.ForeignKey(
+        Message, on_delete=models.SET_NULL, null=True, blank=True, related_name='+'
+    )
+    unread_count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['chat', 'user'], name='unique_chat_read_state'),
+        ]
+
+    def __str__(self):
+        return f"{self.user} in {self.chat}: {self.unread_count} unread"
+
+    def mark_read(self, message):
+        """Move the cursor to message and recount what is still unread after it"""
+        current = self.last_read_message
+        if current is not None and current.position >= message.position:
+            return
+        self.last_read_message = message
+        self.unread_count = (
+            Message.objects.filter(Message.after(message), chat_id=self.chat_id)
+            .exclude(sender_id=self.user_id)
+            .count()
+        )
+        self.save(update_fields=['last_read_message', 'unread_count'])
@@ -0,0 +1,121 @@
+"""Transactional outbox between message writes and socket fan-out.
+
+A write that should reach connected clients appends an ``OutboxEvent`` in
+the same transaction, so an event exists exactly when its message does,
+whichever path (REST or socket) wrote it. Dispatchers in the socket server
+claim events in batches, emit them and delete them; the writer never waits
+on fan-out.
+
+Events are spread over ``settings.OUTBOX_SHARDS`` shards by room. A shard
+is drained by one claim at a time, so a room's events go out in the order
+they were written. A claim is a lease: events of a dispatcher that died
+are claimed again once it runs out, so delivery is at least once and
+clients drop duplicates by id.
+
+When more than ``settings.OUTBOX_MAX_BACKLOG`` events are waiting, writers
+get ``Backlogged`` instead of piling up more work than fan-out can drain.
+The backlog is counted at most every ``settings.OUTBOX_BACKLOG_CHECK_INTERVAL``
+seconds per process; in between, each accepted write adds one to the last
+count.
+"""
+import time
+import uuid
+import zlib
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from rest_framework.exceptions import APIException
+
+from .models import OutboxEvent
+
+_wakeup = None
+_backlog = {'count': 0, 'counted_at': None}
+
+
+class Backlogged(APIException):
+    """Fan-out is too far behind to accept more events"""
+    status_code = 503
+    default_detail = 'Message delivery is behind; try again shortly.'
+    default_code = 'backlogged'
+    # DRF turns this into a Retry-After header.
+    wait = 1
+
+
+def on_enqueue(callback):
+    """Call callback (from any thread) after a transaction that enqueued events commits"""
+    global _wakeup
+    _wakeup = callback
+
+
+def _notify():
+    if _wakeup is not None:
+        _wakeup()
+
+
+def shard_for(room):
+    return zlib.crc32(room.encode()) % settings.OUTBOX_SHARDS
+
+
+def check_backlog():
+    """Raise Backlogged if too many events are waiting, without a COUNT(*) on every write"""
+    now = time.monotonic()
+    counted_at = _backlog['counted_at']
+    if counted_at is None or now - counted_at >= settings.OUTBOX_BACKLOG_CHECK_INTERVAL:
+        _backlog.update(count=OutboxEvent.objects.count(), counted_at=now)
+    if _backlog['count'] >= settings.OUTBOX_MAX_BACKLOG:
+        raise Backlogged()
+    _backlog['count'] += 1
+
+
+def _recount_backlog(setting, **kwargs):
+    if setting.startswith('OUTBOX_'):
+        _backlog['counted_at'] = None
+
+
+setting_changed.connect(_recount_backlog)
+
+
+def enqueue(event, data, room):
+    """Queue an emit of data to room; call inside the transaction of the write it announces"""
+    OutboxEvent.objects.create(event=event, room=room, payload=data, shard=shard_for(room))
+    transaction.on_commit(_notify)
+
+
+def enqueue_many(event, batches, room):
+    OutboxEvent.objects.bulk_create([
+        OutboxEvent(event=event, room=room, payload=data, shard=shard_for(room)) for data in batches
+    ])
+    transaction.on_commit(_notify)
+
+
+def claim(shards, limit=None):
+    """Lease up to limit of the oldest events in shards that no one else is draining"""
+    limit = limit or settings.OUTBOX_BATCH_SIZE
+    now = timezone.now()
+    token = uuid.uuid4().hex
+    free = Q(claimed_until__isnull=True) | Q(claimed_until__lte=now)
+    busy_shards = OutboxEvent.objects.filter(claimed_until__gt=now).values('shard')
+    ids = (
+        OutboxEvent.objects.filter(free, shard__in=shards)
+        .exclude(shard__in=busy_shards)
+        .order_by('id').values('id')[:limit]
+    )
+    claimed = OutboxEvent.objects.filter(free, id__in=ids).update(
+        claimed_by=token, claimed_until=now + timedelta(seconds=settings.OUTBOX_LEASE)
+    )
+    if not claimed:
+        return []
+    return list(OutboxEvent.objects.filter(claimed_by=token).order_by('id'))
+
+
+def complete(events):
+    OutboxEvent.objects.filter(id__in=[event.id for event in events]).delete()
+
+
+def release(events):
+    """Give events back for another attempt"""
+    OutboxEvent.objects.filter(id__in=[event.id for event in events]).update(claimed_by='', claimed_until=None)
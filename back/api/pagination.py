@@ -0,0 +1,215 @@
+import base64
+from collections import OrderedDict
+from operator import attrgetter
+
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, LimitOffsetPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+from . import archive
+
+
+class MessageCursorPagination(BasePagination):
+    """Keyset pagination over (sent_at, id) for chat history.
+
+    With no position the newest page is returned. ``before``/``after`` take a
+    message id, ``cursor`` takes the opaque value from the ``next``/``previous``
+    links. Each page is one bounded range scan on the (chat, sent_at, id) index,
+    whatever the position in the history. Results are always chronological.
+
+    When the view sets ``archive_chat_id``, pages reaching past the chat's hot
+    history are filled from its archive (``api.archive``).
+    """
+    page_size = 50
+    max_page_size = 200
+    page_size_query_param = 'page_size'
+    cursor_query_param = 'cursor'
+    before_query_param = 'before'
+    after_query_param = 'after'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        self.archive_chat_id = getattr(view, 'archive_chat_id', None)
+        direction, position = self.get_position(request, queryset)
+        limit = self.page_size + 1
+
+        if direction == 'after':
+            if position:
+                queryset = queryset.filter(self.after_filter(*position))
+            rows = list(queryset.order_by('sent_at', 'id')[:limit])
+            if self.archive_chat_id is not None:
+                # Archived messages only matter if they come before the last hot row needed.
+                ceiling = rows[-1].position if len(rows) == limit else None
+                rows += archive.messages_after(self.archive_chat_id, position, limit, ceiling)
+                rows = sorted(rows, key=attrgetter('position'))[:limit]
+            self.has_more = len(rows) > self.page_size
+            page = rows[:self.page_size]
+        else:
+            if position:
+                queryset = queryset.filter(self.before_filter(*position))
+            rows = list(queryset.order_by('-sent_at', '-id')[:limit])
+            if self.archive_chat_id is not None:
+                floor = rows[-1].position if len(rows) == limit else None
+                rows += archive.messages_before(self.archive_chat_id, position, limit, floor)
+                rows = sorted(rows, key=attrgetter('position'), reverse=True)[:limit]
+            self.has_more = len(rows) > self.page_size
+            page = list(reversed(rows[:self.page_size]))
+
+        self.direction = direction
+        self.position = position
+        self.page = page
+        return page
+
+    def get_page_size(self, request):
+        try:
+            size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        if size <= 0:
+            return self.page_size
+        return min(size, self.max_page_size)
+
+    def get_position(self, request, queryset):
+        cursor = request.query_params.get(self.cursor_query_param)
+        if cursor:
+            return self.decode_cursor(cursor)
+
+        for direction in (self.before_query_param, self.after_query_param):
+            message_id = request.query_params.get(direction)
+            if message_id:
+                try:
+                    message_id = int(message_id)
+                except ValueError:
+                    raise NotFound('Message not found.')
+                anchor = queryset.filter(id=message_id).values_list('sent_at', 'id').first()
+                if anchor is None and self.archive_chat_id is not None:
+                    anchor = archive.find_position(self.archive_chat_id, message_id)
+                if anchor is None:
+                    raise NotFound('Message not found.')
+                return direction, anchor
+
+        return 'before', None
+
+    # The outer sent_at bound keeps the planner on a single index range that it
+    # can walk in order; a plain OR of the two cases turns into a multi-index
+    # scan plus a sort of everything older than the cursor.
+    @staticmethod
+    def before_filter(sent_at, message_id):
+        return Q(sent_at__lte=sent_at) & (Q(sent_at__lt=sent_at) | Q(id__lt=message_id))
+
+    @staticmethod
+    def after_filter(sent_at, message_id):
+        return Q(sent_at__gte=sent_at) & (Q(sent_at__gt=sent_at) | Q(id__gt=message_id))
+
+    def encode_cursor(self, direction, message):
+        raw = f"{direction}|{message.sent_at.isoformat()}|{message.id}"
+        return base64.urlsafe_b64encode(raw.encode()).decode()
+
+    def decode_cursor(self, cursor):
+        try:
+            raw = base64.urlsafe_b64decode(cursor.encode()).decode()
+            direction, sent_at, message_id = raw.split('|')
+            sent_at = parse_datetime(sent_at)
+            message_id = int(message_id)
+        except (TypeError, ValueError, UnicodeDecodeError):
+            raise NotFound('Invalid cursor.')
+        if direction not in ('before', 'after') or sent_at is None:
+            raise NotFound('Invalid cursor.')
+        return direction, (sent_at, message_id)
+
+    def get_link(self, direction, message):
+        url = self.request.build_absolute_uri()
+        url = remove_query_param(url, self.before_query_param)
+        url = remove_query_param(url, self.after_query_param)
+        return replace_query_param(url, self.cursor_query_param, self.encode_cursor(direction, message))
+
+    def get_previous_link(self):
+        """Link to older messages."""
+        if not self.page:
+            return None
+        if self.direction == 'before' and not self.has_more:
+            return None
+        if self.direction == 'after' and self.position is None:
+            return None
+        return self.get_link('before', self.page[0])
+
+    def get_next_link(self):
+        """Link to newer messages."""
+        if not self.page:
+            return None
+        if self.direction == 'after' and not self.has_more:
+            return None
+        if self.direction == 'before' and self.position is None:
+            return None
+        return self.get_link('after', self.page[-1])
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('previous', self.get_previous_link()),
+            ('results', data),
+        ]))
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'required': ['results'],
+            'properties': {
+                'next': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'previous': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'results': schema,
+            },
+        }
+
+
+class MessageSearchPagination(LimitOffsetPagination):
+    """Limit/offset pages of search results without counting every match.
+
+    One extra row is fetched to tell whether there is a next page. ``truncated``
+    is true when the search left older matches out (see ``MessageSearch``).
+    """
+    default_limit = 20
+    max_limit = 100
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.limit = self.get_limit(request)
+        self.offset = self.get_offset(request)
+        rows = list(queryset[self.offset:self.offset + self.limit + 1])
+        self.has_more = len(rows) > self.limit
+        self.truncated = getattr(queryset, 'truncated', False)
+        return rows[:self.limit]
+
+    def get_next_link(self):
+        if not self.has_more:
+            return None
+        url = self.request.build_absolute_uri()
+        url = replace_query_param(url, self.limit_query_param, self.limit)
+        return replace_query_param(url, self.offset_query_param, self.offset + self.limit)
+
+    def get_previous_link(self):
+        if self.offset <= 0:
+            return None
+        url = self.request.build_absolute_uri()
+        url = replace_query_param(url, self.limit_query_param, self.limit)
+        offset = self.offset - self.limit
+        if offset <= 0:
+            return remove_query_param(url, self.offset_query_param)
+        return replace_query_param(url, self.offset_query_param, offset)
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('previous', self.get_previous_link()),
+            ('truncated', self.truncated),
+            ('results', data),
+        ]))
+
+    def get_paginated_response_schema(self, schema):
+        response_schema = MessageCursorPagination.get_paginated_response_schema(self, schema)
+        response_schema['properties']['truncated'] = {'type': 'boolean'}
+        return response_schema
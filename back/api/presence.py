@@ -0,0 +1,279 @@
+"""Registry of which users are connected to the socket servers.
+
+``LocalPresenceRegistry`` keeps everything in this process. It is enough for a
+single socket server, and it is what ``memory://`` uses as an in-process
+stand-in for a shared broker. ``RedisPresenceRegistry`` keeps the same data in
+Redis, so every socket server node sees the same presence. The backend is
+picked from ``settings.SOCKET_MESSAGE_QUEUE``.
+
+Both count a version that goes up whenever a user comes online or goes
+offline. A snapshot carries the version it was read at and status events
+carry the version at broadcast time, so a client can drop events that are
+older than the snapshot it already holds.
+"""
+import heapq
+import threading
+import time
+
+from django.conf import settings
+
+
+class LocalPresenceRegistry:
+    """In-process presence: user id -> sids, sid -> user id"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sids = {}
+        self._users = {}
+        self._version = 0
+
+    def connect(self, user_id, sid):
+        """Add one of the user's connections; True if it is the user's first"""
+        with self._lock:
+            sids = self._sids.setdefault(user_id, set())
+            first = not sids
+            sids.add(sid)
+            self._users[sid] = user_id
+            if first:
+                self._version += 1
+        return first
+
+    def disconnect(self, sid):
+        """Drop a connection and return (user_id, True if it was the user's last)"""
+        with self._lock:
+            user_id = self._users.pop(sid, None)
+            if user_id is None:
+                return None, False
+            sids = self._sids.get(user_id, set())
+            sids.discard(sid)
+            if sids:
+                return user_id, False
+            self._sids.pop(user_id, None)
+            self._version += 1
+        return user_id, True
+
+    def get_sids(self, user_id):
+        return set(self._sids.get(user_id, ()))
+
+    def get_user(self, sid):
+        return self._users.get(sid)
+
+    def is_online(self, user_id):
+        return bool(self._sids.get(user_id))
+
+    def online(self, user_ids):
+        """Return the subset of user_ids that has at least one connection"""
+        return {user_id for user_id in user_ids if self._sids.get(user_id)}
+
+    def version(self):
+        return self._version
+
+    def snapshot(self, user_ids):
+        """Return ({user_id: is_online}, version) read together"""
+        with self._lock:
+            return {user_id: bool(self._sids.get(user_id)) for user_id in user_ids}, self._version
+
+
+class RedisPresenceRegistry:
+    """Presence shared by every socket server node through Redis"""
+
+    def __init__(self, url, prefix='presence'):
+        import redis
+
+        self.redis = redis.Redis.from_url(url)
+        self.prefix = prefix
+        self.users_key = f'{prefix}:users'
+        self.version_key = f'{prefix}:version'
+
+    def sids_key(self, user_id):
+        return f'{self.prefix}:sids:{user_id}'
+
+    def connect(self, user_id, sid):
+        with self.redis.pipeline() as pipe:
+            pipe.sadd(self.sids_key(user_id), sid)
+            pipe.scard(self.sids_key(user_id))
+            pipe.hset(self.users_key, sid, user_id)
+            added, count = pipe.execute()[:2]
+        first = bool(added) and count == 1
+        if first:
+            self.redis.incr(self.version_key)
+        return first
+
+    def disconnect(self, sid):
+        user_id = self.redis.hget(self.users_key, sid)
+        if user_id is None:
+            return None, False
+        user_id = int(user_id)
+        with self.redis.pipeline() as pipe:
+            pipe.srem(self.sids_key(user_id), sid)
+            pipe.scard(self.sids_key(user_id))
+            pipe.hdel(self.users_key, sid)
+            removed, count = pipe.execute()[:2]
+        last = bool(removed) and count == 0
+        if last:
+            self.redis.incr(self.version_key)
+        return user_id, last
+
+    def get_sids(self, user_id):
+        return {sid.decode() for sid in self.redis.smembers(self.sids_key(user_id))}
+
+    def get_user(self, sid):
+        user_id = self.redis.hget(self.users_key, sid)
+        return int(user_id) if user_id is not None else None
+
+    def is_online(self, user_id):
+        return self.redis.scard(self.sids_key(user_id)) > 0
+
+    def online(self, user_ids):
+        user_ids = list(user_ids)
+        with self.redis.pipeline(transaction=False) as pipe:
+            for user_id in user_ids:
+                pipe.scard(self.sids_key(user_id))
+            counts = pipe.execute()
+        return {user_id for user_id, count in zip(user_ids, counts) if count}
+
+    def version(self):
+        return int(self.redis.get(self.version_key) or 0)
+
+    def snapshot(self, user_ids):
+        user_ids = list(user_ids)
+        with self.redis.pipeline(transaction=False) as pipe:
+            # The version is read first, so the states are at least as new as it.
+            pipe.get(self.version_key)
+            for user_id in user_ids:
+                pipe.scard(self.sids_key(user_id))
+            version, *counts = pipe.execute()
+        return {user_id: bool(count) for user_id, count in zip(user_ids, counts)}, int(version or 0)
+
+
+def parse_user_ids(values):
+    """Distinct integer user ids from a request, at most settings.PRESENCE_BATCH_LIMIT"""
+    if not isinstance(values, (list, tuple)):
+        raise ValueError('user_ids must be a list')
+    try:
+        user_ids = list(dict.fromkeys(int(value) for value in values))
+    except (TypeError, ValueError):
+        raise ValueError('user_ids must be integers')
+    if len(user_ids) > settings.PRESENCE_BATCH_LIMIT:
+        raise ValueError(f'At most {settings.PRESENCE_BATCH_LIMIT} user_ids per request')
+    return user_ids
+
+
+class PresenceBuffer:
+    """Status changes and activity waiting to be written and announced in one batch.
+
+    A change only settles after ``debounce`` seconds, to the user's last marked
+    status, and is then forgotten. A user who drops and comes back within that
+    window settles where they started; the flush compares settled users with
+    the shared registry and the stored status, so nothing is written or
+    broadcast for them, even when they came back through another node.
+    """
+
+    def __init__(self, debounce):
+        self.debounce = debounce
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._active = set()
+
+    def mark(self, user_id, is_online):
+        with self._lock:
+            self._pending[user_id] = (is_online, time.time())
+
+    def touch(self, user_id):
+        with self._lock:
+            self._active.add(user_id)
+
+    def restore(self, changes, active_ids):
+        """Put back what a failed flush drained, unless newer marks came in meanwhile"""
+        with self._lock:
+            for user_id, is_online in changes.items():
+                self._pending.setdefault(user_id, (is_online, 0))
+            self._active |= set(active_ids)
+
+    def drain(self, now=None):
+        """Return the settled {user_id: is_online} statuses and the ids seen active"""
+        now = time.time() if now is None else now
+        changes = {}
+        with self._lock:
+            for user_id, (is_online, changed_at) in list(self._pending.items()):
+                if now - changed_at < self.debounce:
+                    continue
+                del self._pending[user_id]
+                changes[user_id] = is_online
+            active, self._active = self._active, set()
+        return changes, active
+
+
+class IdleTimer:
+    """Idle deadlines for this node's connections, kept in a min-heap.
+
+    ``touch`` only moves the deadline in a dict. A heap entry whose deadline
+    was pushed back is re-queued when it reaches the top, so each check costs
+    O(expired * log n) rather than a scan over every connection.
+    """
+
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._deadlines = {}
+        self._heap = []
+
+    def add(self, sid, now=None):
+        deadline = (time.time() if now is None else now) + self.timeout
+        with self._lock:
+            self._deadlines[sid] = deadline
+            heapq.heappush(self._heap, (deadline, sid))
+
+    def touch(self, sid, now=None):
+        deadline = (time.time() if now is None else now) + self.timeout
+        with self._lock:
+            if sid in self._deadlines:
+                self._deadlines[sid] = deadline
+
+    def remove(self, sid):
+        with self._lock:
+            self._deadlines.pop(sid, None)
+
+    def expired(self, now=None):
+        """Pop and return every sid whose deadline has passed"""
+        now = time.time() if now is None else now
+        expired = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                _, sid = heapq.heappop(self._heap)
+                deadline = self._deadlines.get(sid)
+                if deadline is None:
+                    continue
+                if deadline > now:
+                    heapq.heappush(self._heap, (deadline, sid))
+                    continue
+                del self._deadlines[sid]
+                expired.append(sid)
+        return expired
+
+    def __len__(self):
+        return len(self._deadlines)
+
+
+_registries = {}
+
+
+def get_presence_registry():
+    """Return the process-wide registry for settings.SOCKET_MESSAGE_QUEUE"""
+    url = settings.SOCKET_MESSAGE_QUEUE
+    if url not in _registries:
+        if url.startswith(('redis://', 'rediss://', 'unix://')):
+            _registries[url] = RedisPresenceRegistry(url)
+        else:
+            _registries[url] = LocalPresenceRegistry()
+    return _registries[url]
+
+
+def get_shared_presence_registry():
+    """The registry the socket servers write to, or None if it lives only in the socket server's process.
+
+    Without a SOCKET_MESSAGE_QUEUE a single socket server keeps presence in
+    its own memory, and the registry of any other process (a REST worker) is
+    always empty.
+    """
+    return get_presence_registry() if settings.SOCKET_MESSAGE_QUEUE else None
@@ -0,0 +1,56 @@
+"""Cached profile representations.
+
+``UserViewSet.retrieve`` and ``public_profile`` are requested for every
+avatar bubble the UI draws, so their payloads are cached per user for
+``settings.PROFILE_CACHE_TIMEOUT`` seconds together with an ETag; a client
+that already has the payload gets a 304 without a database read. Profile
+and avatar saves, new avatar variants and presence writes drop the user's
+entries right away.
+
+The payload holds absolute URLs, so each entry keeps one copy per host the
+API was reached under, all under one key per user and kind.
+"""
+import hashlib
+import json
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.http import parse_etags
+
+# Kinds of cached payload; 'public' is the one presence changes affect.
+PROFILE = 'profile'
+PUBLIC_PROFILE = 'public'
+
+
+def profile_cache_key(kind, user_id):
+    return f'user-profile:{kind}:{user_id}'
+
+
+def payload_etag(data):
+    encoded = json.dumps(data, sort_keys=True, default=str).encode()
+    return f'"{hashlib.sha1(encoded).hexdigest()}"'
+
+
+def cached_profile(kind, user_id, base_url, build):
+    """(etag, data) for the user from the cache, calling build() on a miss"""
+    key = profile_cache_key(kind, user_id)
+    entry = cache.get(key) or {}
+    if base_url in entry:
+        return entry[base_url]
+
+    data = build()
+    entry[base_url] = (payload_etag(data), data)
+    cache.set(key, entry, settings.PROFILE_CACHE_TIMEOUT)
+    return entry[base_url]
+
+
+def invalidate_profiles(user_ids, kinds=(PROFILE, PUBLIC_PROFILE)):
+    keys = [profile_cache_key(kind, user_id) for user_id in user_ids for kind in kinds]
+    if keys:
+        cache.delete_many(keys)
+
+
+def etag_matches(request, etag):
+    """Whether the client's If-None-Match already names etag"""
+    etags = parse_etags(request.headers.get('If-None-Match', ''))
+    return etag in etags or '*' in etags
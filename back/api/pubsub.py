@@ -0,0 +1,67 @@
+"""Socket.IO client managers that let several socket server nodes share clients.
+
+With ``settings.SOCKET_MESSAGE_QUEUE`` unset each node only reaches its own
+connections. ``redis://...`` uses python-socketio's Redis manager, and
+``memory://`` routes through a broker living in this process, which is what
+the tests use to run several nodes side by side.
+"""
+import asyncio
+import pickle
+
+import socketio
+from socketio.async_pubsub_manager import AsyncPubSubManager
+from django.conf import settings
+
+
+class MemoryBroker:
+    """Minimal in-process pub/sub: every subscriber gets every published message"""
+
+    def __init__(self):
+        self.subscribers = {}
+
+    def subscribe(self, channel):
+        queue = asyncio.Queue()
+        self.subscribers.setdefault(channel, []).append(queue)
+        return queue
+
+    def unsubscribe(self, channel, queue):
+        queues = self.subscribers.get(channel, [])
+        if queue in queues:
+            queues.remove(queue)
+
+    def publish(self, channel, message):
+        for queue in self.subscribers.get(channel, []):
+            queue.put_nowait(message)
+
+
+memory_broker = MemoryBroker()
+
+
+class AsyncMemoryManager(AsyncPubSubManager):
+    name = 'asyncmemory'
+
+    def __init__(self, broker=None, channel='socketio', write_only=False, logger=None):
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+        self.broker = broker or memory_broker
+
+    async def _publish(self, data):
+        # Pickle like the network backends do, so nodes never share objects.
+        self.broker.publish(self.channel, pickle.dumps(data))
+
+    async def _listen(self):
+        queue = self.broker.subscribe(self.channel)
+        try:
+            while True:
+                yield await queue.get()
+        finally:
+            self.broker.unsubscribe(self.channel, queue)
+
+
+def get_client_manager():
+    """Build the client manager for settings.SOCKET_MESSAGE_QUEUE, or None for a single node"""
+    url = settings.SOCKET_MESSAGE_QUEUE
+    if not url:
+        return None
+    if url.startswith('memory://'):
+        return AsyncMemoryManager()
+    return socketio.AsyncRedisManager(url)
@@ -0,0 +1,64 @@
+"""Keep Socket.IO rooms in step with chat membership from Django code.
+
+REST views and the socket server usually run as separate processes with no
+message queue between them, so membership changes do not touch sockets
+directly. ``join_chat`` and ``leave_chat`` queue control events through the
+outbox (``api.outbox``) in the transaction of the change, in the chat's
+room, and the socket server's dispatchers apply them ahead of anything
+later emitted to that room, like ``chat:created`` or the chat's first
+message. With several nodes, entering and leaving rooms reaches sockets
+held by the others through the shared ``SOCKET_MESSAGE_QUEUE``.
+"""
+from . import outbox
+from .presence import get_presence_registry
+
+# Outbox events the dispatchers apply to rooms instead of emitting.
+JOIN_CHAT = 'rooms:join'
+LEAVE_CHAT = 'rooms:leave'
+ROOM_EVENTS = (JOIN_CHAT, LEAVE_CHAT)
+
+
+def chat_room(chat_id):
+    return f"chat:{chat_id}"
+
+
+def presence_room(user_id):
+    """Room of everyone who should hear about user_id going online or offline"""
+    return f"presence:{user_id}"
+
+
+def chat_memberships(chat_id, user_ids, presence=None, member_ids=()):
+    """(sid, room) pairs to enter once user_ids join chat_id, whose other members are member_ids"""
+    presence = presence or get_presence_registry()
+    user_ids = set(user_ids)
+    members = user_ids | set(member_ids)
+    pairs = []
+    for user_id in members:
+        # Joining users meet every member; members already there only meet the newcomers.
+        others = members if user_id in user_ids else user_ids
+        rooms = [presence_room(other) for other in others if other != user_id]
+        if user_id in user_ids:
+            rooms.append(chat_room(chat_id))
+        pairs.extend((sid, room) for sid in presence.get_sids(user_id) for room in rooms)
+    return pairs
+
+
+def chat_departures(chat_id, user_ids, presence=None):
+    """(sid, room) pairs to leave once user_ids leave chat_id.
+
+    Presence rooms are kept, as the users may still share another chat.
+    """
+    presence = presence or get_presence_registry()
+    return [(sid, chat_room(chat_id)) for user_id in user_ids for sid in presence.get_sids(user_id)]
+
+
+def join_chat(chat_id, user_ids, member_ids=()):
+    """Queue putting the connected user_ids into a chat's room, and them and member_ids into each other's presence rooms"""
+    outbox.enqueue(JOIN_CHAT, {
+        'chat_id': chat_id, 'user_ids': sorted(user_ids), 'member_ids': sorted(member_ids),
+    }, room=chat_room(chat_id))
+
+
+def leave_chat(chat_id, user_ids):
+    """Queue taking the connected user_ids out of a chat's room"""
+    outbox.enqueue(LEAVE_CHAT, {'chat_id': chat_id, 'user_ids': sorted(user_ids)}, room=chat_room(chat_id))
@@ -0,0 +1,97 @@
+"""Routing read-only traffic to read replicas.
+
+Views mixing in ``ReplicaReadsMixin`` run the actions in their
+``replica_actions`` against a replica from ``settings.DATABASE_REPLICAS``,
+picked per request; ``ReplicaRouter`` sends every read inside ``reads()``
+there and every write to the primary. Replicas lag behind, so after a
+user's write (a successful unsafe request through the mixin, or a write
+from the socket server) that user reads from the primary for
+``settings.REPLICA_STICKY_SECONDS``; so do the members of a new chat, who
+are told about it right away. The marker lives in the shared cache,
+so it holds across REST workers and socket servers.
+
+Other users may briefly see the replica's older state. That is fine for a
+response, but not for something that outlives it, so cached payloads
+(profiles, typeahead prefixes) and the sync log keep reading from the
+primary.
+"""
+import random
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS
+from rest_framework.permissions import SAFE_METHODS
+
+_replica = ContextVar('replica', default=None)
+
+
+def sticky_key(user_id):
+    return f'db-sticky:{user_id}'
+
+
+def mark_written(*user_ids):
+    """Keep the users on the primary until replicas have caught up with a write they will look for"""
+    if settings.DATABASE_REPLICAS:
+        cache.set_many(
+            {sticky_key(user_id): True for user_id in user_ids if user_id}, settings.REPLICA_STICKY_SECONDS
+        )
+
+
+def choose_replica(user_id=None):
+    """A replica alias to read from, or None for the primary"""
+    if not settings.DATABASE_REPLICAS:
+        return None
+    if user_id and cache.get(sticky_key(user_id)):
+        return None
+    return random.choice(settings.DATABASE_REPLICAS)
+
+
+@contextmanager
+def reads(user_id=None):
+    """Send the reads in the block to a replica unless user_id wrote recently"""
+    token = _replica.set(choose_replica(user_id))
+    try:
+        yield
+    finally:
+        _replica.reset(token)
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        return _replica.get()
+
+    def db_for_write(self, model, **hints):
+        # Objects read from a replica are saved to the primary, not back where they came from.
+        instance = hints.get('instance')
+        if instance is not None and instance._state.db in settings.DATABASE_REPLICAS:
+            return DEFAULT_DB_ALIAS
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True
+
+    def allow_migrate(self, db, app_label, **hints):
+        return db not in settings.DATABASE_REPLICAS
+
+
+class ReplicaReadsMixin:
+    """Serve replica_actions from a replica and mark users who write as sticky"""
+    replica_actions = ('list', 'retrieve')
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        replica = None
+        if request.method in SAFE_METHODS and self.action in self.replica_actions:
+            replica = choose_replica(request.user.id)
+        self._replica_token = _replica.set(replica)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        token = getattr(self, '_replica_token', None)
+        if token is not None:
+            _replica.reset(token)
+            self._replica_token = None
+        if request.method not in SAFE_METHODS and response.status_code < 400:
+            mark_written(request.user.id)
+        return super().finalize_response(request, response, *args, **kwargs)
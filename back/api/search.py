@@ -0,0 +1,228 @@
+"""Full-text search over message text and prefix search over users.
+
+On SQLite the index is the FTS5 table ``api_message_fts`` (migration 0005),
+kept in step with ``api_message`` by triggers. Rebuilding ``api_message`` in a
+later migration drops those triggers, so such a migration has to recreate them.
+On PostgreSQL it is a GIN index over the message's ``simple`` tsvector
+(migration 0014). Either way the newest ``MessageSearch.max_candidates``
+matches are ranked (bm25 or ts_rank), newest first among equal scores; older
+matches are not returned, and ``MessageSearch.truncated`` says when that
+happened. Other database backends fall back to a ``LIKE`` scan ordered by
+recency.
+
+Only ``api_message`` is searched. Messages moved into the archive (see
+``api.archive``) are no longer found.
+
+User typeahead walks the ``lower(username)`` and ``lower(email)`` indexes
+(migration 0006) as a range. The part of the answer that does not depend on
+the caller is cached per prefix.
+"""
+import re
+from urllib.parse import quote
+
+from django.conf import settings
+from django.contrib.postgres.search import SearchQuery, SearchRank, SearchVector
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, connections, router
+from django.db.models import Q
+from django.db.models.functions import Lower
+
+from .models import Chat, Message, User
+
+FTS_TABLE = 'api_message_fts'
+
+# Text search configuration of the PostgreSQL index: no stemming or stop
+# words, like the FTS5 tokenizer.
+SEARCH_CONFIG = 'simple'
+
+# Same split as FTS5's unicode61 tokenizer, so a query never carries syntax.
+TOKEN_RE = re.compile(r'[^\W_]+')
+
+
+def tokenize(text):
+    return TOKEN_RE.findall(text or '')
+
+
+def build_match_query(tokens):
+    """Every word must occur; the last one may still be being typed, so it matches as a prefix"""
+    terms = [f'"{token}"' for token in tokens]
+    terms[-1] += '*'
+    return ' '.join(terms)
+
+
+def build_tsquery(tokens):
+    """build_match_query for PostgreSQL's to_tsquery"""
+    terms = [f"'{token}'" for token in tokens]
+    terms[-1] += ':*'
+    return ' & '.join(terms)
+
+
+def search_vector():
+    # The expression the GIN index of migration 0014 is built on.
+    return SearchVector('text', config=SEARCH_CONFIG)
+
+
+class MessageSearch:
+    """Messages of the user's chats matching text, fetched one slice at a time.
+
+    After a slice has been fetched, ``truncated`` tells whether more than
+    ``max_candidates`` messages matched, so that older ones were left out.
+    """
+    max_candidates = 500
+
+    def __init__(self, user, text, chat_id=None, using=None):
+        self.user = user
+        self.tokens = tokenize(text)
+        self.chat_id = chat_id
+        self.using = using or router.db_for_read(Message)
+        self.truncated = False
+
+    def __getitem__(self, window):
+        if not self.tokens:
+            return []
+        offset = window.start or 0
+        limit = window.stop - offset
+        vendor = connections[self.using].vendor
+        if vendor == 'sqlite':
+            return self.fetch_ranked(limit, offset)
+        if vendor == 'postgresql':
+            return self.fetch_ranked_postgresql(limit, offset)
+        return list(self.like_queryset()[offset:offset + limit])
+
+    def fetch_ranked(self, limit, offset):
+        # FTS5 walks matches newest first and stops after max_candidates in
+        # scope; only those get a bm25 score. Scoring every match of a common
+        # word would cost more than the LIKE scan it replaces. One match more
+        # is read to tell whether any were left out.
+        sql = (
+            'WITH matches AS ('
+            f'SELECT {FTS_TABLE}.rowid AS id, {FTS_TABLE}.rank AS score FROM {FTS_TABLE} '
+            f'JOIN api_message m ON m.id = {FTS_TABLE}.rowid '
+            f'WHERE {FTS_TABLE} MATCH %s '
+            'AND m.chat_id IN (SELECT chat_id FROM api_chat_participants WHERE user_id = %s) '
+        )
+        params = [build_match_query(self.tokens), self.user.id]
+        if self.chat_id is not None:
+            sql += 'AND m.chat_id = %s '
+            params.append(self.chat_id)
+        sql += (
+            f'ORDER BY {FTS_TABLE}.rowid DESC LIMIT %s), '
+            'candidates AS (SELECT id, score FROM matches ORDER BY id DESC LIMIT %s) '
+            'SELECT id, (SELECT COUNT(*) FROM matches) FROM candidates ORDER BY score, id DESC LIMIT %s OFFSET %s'
+        )
+        params += [self.max_candidates + 1, self.max_candidates, limit, offset]
+
+        with connections[self.using].cursor() as cursor:
+            cursor.execute(sql, params)
+            rows = cursor.fetchall()
+        ids = [row[0] for row in rows]
+        if rows:
+            self.truncated = rows[0][1] > self.max_candidates
+
+        messages = Message.objects.using(self.using).select_related('sender').in_bulk(ids)
+        return [messages[message_id] for message_id in ids if message_id in messages]
+
+    def fetch_ranked_postgresql(self, limit, offset):
+        # The same plan as fetch_ranked: the GIN index finds the newest
+        # max_candidates matches and only those are ranked.
+        query = SearchQuery(build_tsquery(self.tokens), search_type='raw', config=SEARCH_CONFIG)
+        ids = list(
+            self.scoped().annotate(document=search_vector()).filter(document=query)
+            .order_by('-id').values_list('id', flat=True)[:self.max_candidates + 1]
+        )
+        self.truncated = len(ids) > self.max_candidates
+        return list(
+            Message.objects.using(self.using).select_related('sender')
+            .filter(id__in=ids[:self.max_candidates])
+            .annotate(score=SearchRank(search_vector(), query))
+            .order_by('-score', '-id')[offset:offset + limit]
+        )
+
+    def scoped(self):
+        """Messages of the user's chats, or of the one chat asked for"""
+        chats = Chat.objects.using(self.using).filter(participants=self.user)
+        if self.chat_id is not None:
+            chats = chats.filter(id=self.chat_id)
+        return Message.objects.using(self.using).filter(chat__in=chats)
+
+    def like_queryset(self):
+        """The unindexed equivalent: every word as a substring"""
+        condition = Q()
+        for token in self.tokens:
+            condition &= Q(text__icontains=token)
+        return self.scoped().select_related('sender').filter(condition).order_by('-sent_at', '-id')
+
+
+TYPEAHEAD_LIMIT = 20
+
+# Longer prefixes are rarely repeated and already narrow the range to a few rows.
+TYPEAHEAD_CACHED_PREFIX_LENGTH = 8
+
+
+def typeahead_cache_key(prefix):
+    return f'user-typeahead:{quote(prefix)}'
+
+
+def prefix_filter(field, prefix):
+    """lower(field) in [prefix, next prefix): a plain range, so the expression index serves it"""
+    upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+    return Q(**{f'{field}_lower__gte': prefix, f'{field}_lower__lt': upper})
+
+
+def users_with_prefix(queryset, prefix, limit):
+    """Ids of up to limit users whose username or email starts with prefix, by username"""
+    by_username = (
+        queryset.annotate(username_lower=Lower('username'))
+        .filter(prefix_filter('username', prefix))
+        .order_by('username_lower')
+        .values_list('username_lower', 'id')[:limit]
+    )
+    by_email = (
+        queryset.annotate(username_lower=Lower('username'), email_lower=Lower('email'))
+        .filter(prefix_filter('email', prefix))
+        .order_by('email_lower')
+        .values_list('username_lower', 'id')[:limit]
+    )
+    return [user_id for _, user_id in sorted(set(by_username) | set(by_email))][:limit]
+
+
+def global_prefix_matches(prefix):
+    """Caller-independent matches, cached per prefix"""
+    if len(prefix) > TYPEAHEAD_CACHED_PREFIX_LENGTH:
+        return users_with_prefix(User.objects.all(), prefix, TYPEAHEAD_LIMIT + 1)
+    # Built from the primary so a lagging replica never ends up in the cache.
+    return cache.get_or_set(
+        typeahead_cache_key(prefix),
+        lambda: users_with_prefix(User.objects.using(DEFAULT_DB_ALIAS), prefix, TYPEAHEAD_LIMIT + 1),
+        settings.USER_TYPEAHEAD_CACHE_TIMEOUT,
+    )
+
+
+def typeahead(user, text, limit=TYPEAHEAD_LIMIT):
+    """Users whose username or email starts with text, people the user already chats with first"""
+    prefix = (text or '').strip().lower()
+    if not prefix:
+        return []
+    limit = max(1, min(limit, TYPEAHEAD_LIMIT))
+
+    contacts = User.objects.filter(chats__participants=user).exclude(id=user.id).distinct()
+    contact_ids = users_with_prefix(contacts, prefix, limit)
+
+    # One extra row is cached so dropping the caller still leaves enough.
+    seen = set(contact_ids) | {user.id}
+    ids = contact_ids + [user_id for user_id in global_prefix_matches(prefix) if user_id not in seen]
+    ids = ids[:limit]
+
+    users = User.objects.in_bulk(ids)
+    return [users[user_id] for user_id in ids if user_id in users]
+
+
+def invalidate_typeahead(*values):
+    """Drop the cached prefixes of the given usernames and emails"""
+    keys = set()
+    for value in values:
+        value = (value or '').lower()
+        for length in range(1, min(len(value), TYPEAHEAD_CACHED_PREFIX_LENGTH) + 1):
+            keys.add(typeahead_cache_key(value[:length]))
+    if keys:
+        cache.delete_many(keys)
@@ -1,6 +1,9 @@
 from rest_framework import serializers
+from django.conf import settings
 from django.contrib.auth import get_user_model
-from .models import Chat, Message, Image
+from . import uploads
+from .models import Chat, Message, Image, Upload
+from .thumbnails import image_url, variant_urls
 import os
 
 User = get_user_model()
@@ -29,13 +32,6 @@ class RegisterSerializer(serializers.ModelSerializer):
         avatar_file = self.context['request'].FILES.get('avatar') if 'request' in self.context else None
         
         if avatar_file:
-            if instance.avatar:
-                try:
-                    if os.path.isfile(instance.avatar.path):
-                        os.remove(instance.avatar.path)
-                except (ValueError, OSError):
-                    pass
-            
             instance.avatar = avatar_file
         
         return super().update(instance, validated_data)
@@ -43,31 +39,65 @@ class RegisterSerializer(serializers.ModelSerializer):
 
 class UserSerializer(serializers.ModelSerializer):
     avatar_url = serializers.SerializerMethodField()
+    avatar_variants = serializers.SerializerMethodField()
     
     class Meta:
         model = User
-        fields = ['id', 'username', 'email', 'bio', 'avatar', 'avatar_url', 'is_online', 'last_active']
+        fields = [
+            'id', 'username', 'email', 'bio', 'avatar', 'avatar_url', 'avatar_variants',
+            'is_online', 'last_active'
+        ]
         read_only_fields = ['avatar_url', 'last_active']
     
     def get_avatar_url(self, obj):
-        if obj.avatar and hasattr(obj.avatar, 'url'):
-            request = self.context.get('request')
-            if request:
-                return request.build_absolute_uri(obj.avatar.url)
-            return obj.avatar.url
-        return None
+        return image_url(obj.avatar, obj.avatar_variants, self.context.get('request'))
+
+    def get_avatar_variants(self, obj):
+        return variant_urls(obj.avatar, obj.avatar_variants, self.context.get('request'))
 
 
 class MessageSerializer(serializers.ModelSerializer):
     sender_username = serializers.SerializerMethodField()
+    image_variants = serializers.SerializerMethodField()
+    upload = serializers.UUIDField(write_only=True, required=False)
     
     class Meta:
         model = Message
-        fields = ['id', 'sender', 'chat', 'text', 'image', 'sent_at', 'is_read', 'sender_username']
+        fields = [
+            'id', 'sender', 'chat', 'text', 'image', 'image_variants', 'upload', 'sent_at', 'is_read',
+            'sender_username'
+        ]
+        read_only_fields = ['sender', 'sent_at']
     
+    def create(self, validated_data):
+        upload_id = validated_data.pop('upload', None)
+        if upload_id:
+            validated_data['image'] = uploads.claim(validated_data['sender'], upload_id)
+        return super().create(validated_data)
+
     def get_sender_username(self, obj):
         return obj.sender.username
 
+    def get_image_variants(self, obj):
+        return variant_urls(obj.image, obj.image_variants, self.context.get('request'))
+
+
+class BulkMessageItemSerializer(serializers.Serializer):
+    text = serializers.CharField()
+    # Importing history on behalf of other participants is for staff only.
+    sender = serializers.IntegerField(required=False)
+    sent_at = serializers.DateTimeField(required=False)
+
+
+class BulkMessageSerializer(serializers.Serializer):
+    chat = serializers.PrimaryKeyRelatedField(queryset=Chat.objects.all())
+    messages = BulkMessageItemSerializer(many=True, allow_empty=False)
+
+    def validate_messages(self, value):
+        if len(value) > settings.MESSAGE_BULK_LIMIT:
+            raise serializers.ValidationError(f'At most {settings.MESSAGE_BULK_LIMIT} messages per request.')
+        return value
+
 
 class LastMessageSerializer(serializers.ModelSerializer):
     sender_username = serializers.SerializerMethodField()
@@ -88,27 +118,25 @@ class ChatParticipantSerializer(serializers.ModelSerializer):
         fields = ['id', 'username', 'avatar_url', 'is_online']
     
     def get_avatar_url(self, obj):
-        if obj.avatar and hasattr(obj.avatar, 'url'):
-            request = self.context.get('request')
-            if request:
-                return request.build_absolute_uri(obj.avatar.url)
-            return obj.avatar.url
-        return None
+        # Chat lists draw small avatars; the thumbnail is enough.
+        return image_url(obj.avatar, obj.avatar_variants, self.context.get('request'), size=64)
 
 
 class ChatSerializer(serializers.ModelSerializer):
-    last_message = serializers.SerializerMethodField()
+    last_message = LastMessageSerializer(read_only=True)
     participants_details = serializers.SerializerMethodField()
+    unread_count = serializers.SerializerMethodField()
     
     class Meta:
         model = Chat
-        fields = ['id', 'name', 'participants', 'participants_details', 'is_group', 'created_at', 'last_message']
+        fields = [
+            'id', 'name', 'participants', 'participants_details', 'is_group', 'created_at',
+            'last_message', 'last_activity_at', 'unread_count'
+        ]
+        read_only_fields = ['last_activity_at']
     
-    def get_last_message(self, obj):
-        last_message = obj.messages.order_by('-sent_at').first()
-        if last_message:
-            return LastMessageSerializer(last_message).data
-        return None
+    def get_unread_count(self, obj):
+        return getattr(obj, 'unread_count', None) or 0
     
     def get_participants_details(self, obj):
         participants = obj.participants.all()
@@ -118,18 +146,60 @@ class ChatSerializer(serializers.ModelSerializer):
 class ImageSerializer(serializers.ModelSerializer):
     uploader_username = serializers.SerializerMethodField()
     image_url = serializers.SerializerMethodField()
+    image_variants = serializers.SerializerMethodField()
+    upload = serializers.UUIDField(write_only=True, required=False)
     
     class Meta:
         model = Image
-        fields = ['id', 'uploader', 'uploader_username', 'image', 'image_url', 'caption', 'uploaded_at']
+        fields = [
+            'id', 'uploader', 'uploader_username', 'image', 'image_url', 'image_variants',
+            'upload', 'caption', 'uploaded_at'
+        ]
+        extra_kwargs = {'image': {'required': False}}
+
+    def validate(self, attrs):
+        if not attrs.get('image') and not attrs.get('upload') and self.instance is None:
+            raise serializers.ValidationError({'image': 'Send an image or the id of a completed upload.'})
+        return attrs
+
+    def create(self, validated_data):
+        upload_id = validated_data.pop('upload', None)
+        if upload_id:
+            validated_data['image'] = uploads.claim(validated_data['uploader'], upload_id)
+        return super().create(validated_data)
     
     def get_uploader_username(self, obj):
         return obj.uploader.username
     
     def get_image_url(self, obj):
-        if obj.image and hasattr(obj.image, 'url'):
-            request = self.context.get('request')
-            if request:
-                return request.build_absolute_uri(obj.image.url)
-            return obj.image.url
-        return None
\ No newline at end of file
+        return image_url(obj.image, obj.image_variants, self.context.get('request'))
+
+    def get_image_variants(self, obj):
+        return variant_urls(obj.image, obj.image_variants, self.context.get('request'))
+
+
+class UploadSerializer(serializers.ModelSerializer):
+    offset = serializers.IntegerField(source='received', read_only=True)
+    max_chunk_size = serializers.SerializerMethodField()
+
+    class Meta:
+        model = Upload
+        fields = ['id', 'filename', 'size', 'sha256', 'offset', 'max_chunk_size', 'status', 'file', 'created_at']
+        read_only_fields = ['status', 'file']
+
+    def get_max_chunk_size(self, obj):
+        return settings.UPLOAD_CHUNK_MAX_SIZE
+
+    def validate_size(self, value):
+        if value > settings.UPLOAD_MAX_SIZE:
+            raise serializers.ValidationError(f'Uploads are limited to {settings.UPLOAD_MAX_SIZE} bytes.')
+        return value
+
+    def validate_sha256(self, value):
+        value = value.lower()
+        if len(value) != 64 or any(c not in '0123456789abcdef' for c in value):
+            raise serializers.ValidationError('Expected a hex SHA-256 digest.')
+        return value
+
+    def validate_filename(self, value):
+        return os.path.basename(value)
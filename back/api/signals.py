@@ -0,0 +1,225 @@
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete, pre_save
+from django.dispatch import receiver
+
+from . import media, realtime, sync, thumbnails
+from .models import Change, Chat, ChatReadState, Image, Message, MessageArchive, Upload, User
+from .profiles import invalidate_profiles
+from .search import invalidate_typeahead
+
+TYPEAHEAD_FIELDS = {'username', 'email'}
+MEDIA_FIELDS = dict(media.REFERENCING_FIELDS)
+UNCHANGED = object()
+
+
+@receiver(m2m_changed, sender=Chat.participants.through)
+def sync_read_states(sender, instance, action, reverse, pk_set, **kwargs):
+    """Keep one read cursor per chat participant"""
+    if action == 'post_add':
+        if reverse:
+            pairs = [(chat_id, instance.pk) for chat_id in pk_set]
+        else:
+            pairs = [(instance.pk, user_id) for user_id in pk_set]
+        ChatReadState.objects.bulk_create(
+            [ChatReadState(chat_id=chat_id, user_id=user_id) for chat_id, user_id in pairs],
+            ignore_conflicts=True,
+        )
+    elif action == 'post_remove':
+        if reverse:
+            ChatReadState.objects.filter(user=instance, chat_id__in=pk_set).delete()
+        else:
+            ChatReadState.objects.filter(chat=instance, user_id__in=pk_set).delete()
+    elif action == 'post_clear':
+        if reverse:
+            ChatReadState.objects.filter(user=instance).delete()
+        else:
+            ChatReadState.objects.filter(chat=instance).delete()
+
+
+@receiver(m2m_changed, sender=Chat.participants.through)
+def log_membership_change(sender, instance, action, reverse, pk_set, **kwargs):
+    """Tell joining and leaving users, and the chat's other participants, through the sync log"""
+    if action == 'pre_clear':
+        related = instance.chats if reverse else instance.participants
+        pk_set = set(related.values_list('id', flat=True))
+        instance._cleared_participants = pk_set
+        return
+    if action == 'post_clear':
+        pk_set = getattr(instance, '_cleared_participants', set())
+    elif action not in ('post_add', 'post_remove'):
+        return
+
+    kind = Change.CHAT if action == 'post_add' else Change.LEFT
+    if reverse:
+        for chat_id in pk_set:
+            sync.record(kind, chat_id, user_ids=[instance.pk])
+            sync.record(Change.CHAT, chat_id)
+    elif pk_set:
+        sync.record(kind, instance.pk, user_ids=sorted(pk_set))
+        sync.record(Change.CHAT, instance.pk)
+
+
+@receiver(m2m_changed, sender=Chat.participants.through)
+def update_chat_rooms(sender, instance, action, reverse, pk_set, **kwargs):
+    """Queue moving the open sockets of joining and leaving users in and out of the chat's room"""
+    if action == 'post_clear':
+        # Collected by log_membership_change on pre_clear.
+        pk_set = getattr(instance, '_cleared_participants', set())
+    elif action not in ('post_add', 'post_remove'):
+        return
+    if not pk_set:
+        return
+
+    if reverse:
+        changes = [(chat_id, [instance.pk]) for chat_id in pk_set]
+    else:
+        changes = [(instance.pk, sorted(pk_set))]
+    through = Chat.participants.through
+    for chat_id, user_ids in changes:
+        if action == 'post_add':
+            member_ids = through.objects.filter(chat_id=chat_id).exclude(user_id__in=user_ids)
+            realtime.join_chat(chat_id, user_ids, member_ids.values_list('user_id', flat=True))
+        else:
+            realtime.leave_chat(chat_id, user_ids)
+
+
+@receiver(post_save, sender=Chat)
+def log_chat_change(sender, instance, **kwargs):
+    sync.record(Change.CHAT, instance.pk)
+
+
+@receiver(pre_delete, sender=Chat)
+def log_chat_deletion(sender, instance, **kwargs):
+    sync.record(Change.LEFT, instance.pk, user_ids=list(instance.participants.values_list('id', flat=True)))
+
+
+@receiver(post_save, sender=Message)
+def log_message_change(sender, instance, **kwargs):
+    sync.record(Change.MESSAGE, instance.chat_id, instance.pk)
+
+
+@receiver(post_delete, sender=Message)
+def log_message_deletion(sender, instance, **kwargs):
+    sync.record(Change.MESSAGE_DELETED, instance.chat_id, instance.pk)
+
+
+@receiver(pre_delete, sender=Message)
+def remember_readers(sender, instance, **kwargs):
+    """Note whose cursor points at the message and who has not read it, before SET_NULL hides it"""
+    instance._cursor_user_ids, instance._unread_user_ids = [], []
+    states = ChatReadState.objects.filter(chat_id=instance.chat_id).values_list(
+        'user_id', 'last_read_message_id', 'last_read_message__sent_at'
+    )
+    for user_id, cursor_id, cursor_sent_at in states:
+        if cursor_id == instance.pk:
+            instance._cursor_user_ids.append(user_id)
+        elif user_id != instance.sender_id and (cursor_id is None or (cursor_sent_at, cursor_id) < instance.position):
+            instance._unread_user_ids.append(user_id)
+
+
+@receiver(post_delete, sender=Message)
+def forget_deleted_message(sender, instance, **kwargs):
+    Chat(pk=instance.chat_id).forget_message(
+        instance, getattr(instance, '_cursor_user_ids', []), getattr(instance, '_unread_user_ids', [])
+    )
+
+
+@receiver(post_save, sender=ChatReadState)
+def log_read_state_change(sender, instance, created, **kwargs):
+    # Only the reader's own unread count changed.
+    if not created:
+        sync.record(Change.CHAT, instance.chat_id, user_ids=[instance.user_id])
+
+
+@receiver(pre_save, sender=User)
+def remember_typeahead_values(sender, instance, update_fields=None, **kwargs):
+    """Keep the stored username and email so post_save can drop their cached prefixes"""
+    instance._typeahead_previous = ()
+    if instance.pk is None or (update_fields is not None and not TYPEAHEAD_FIELDS & set(update_fields)):
+        return
+    instance._typeahead_previous = tuple(
+        User.objects.filter(pk=instance.pk).values_list('username', 'email').first() or ()
+    )
+
+
+@receiver(post_save, sender=User)
+def invalidate_typeahead_on_save(sender, instance, created, **kwargs):
+    previous = getattr(instance, '_typeahead_previous', ())
+    current = (instance.username, instance.email)
+    if created or (previous and tuple(previous) != current):
+        invalidate_typeahead(*previous, *current)
+
+
+@receiver(post_delete, sender=User)
+def invalidate_typeahead_on_delete(sender, instance, **kwargs):
+    invalidate_typeahead(instance.username, instance.email)
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def invalidate_profile(sender, instance, **kwargs):
+    invalidate_profiles([instance.pk])
+
+
+@receiver(pre_save, sender=User)
+@receiver(pre_save, sender=Message)
+@receiver(pre_save, sender=Image)
+def detect_new_image(sender, instance, update_fields=None, **kwargs):
+    """Flag rows whose image is a fresh upload or no longer matches its variants"""
+    field, variants_field = thumbnails.IMAGE_FIELDS[sender]
+    if update_fields is not None and field not in update_fields:
+        instance._image_changed = False
+        return
+    file = getattr(instance, field)
+    source = (getattr(instance, variants_field) or {}).get('source')
+    instance._image_changed = (bool(file) and not file._committed) or (file.name or None) != source
+
+
+@receiver(post_save, sender=User)
+@receiver(post_save, sender=Message)
+@receiver(post_save, sender=Image)
+def schedule_image_variants(sender, instance, **kwargs):
+    if getattr(instance, '_image_changed', False):
+        thumbnails.schedule(instance)
+
+
+@receiver(pre_save, sender=User)
+@receiver(pre_save, sender=Message)
+@receiver(pre_save, sender=Image)
+@receiver(pre_save, sender=Upload)
+def remember_stored_file(sender, instance, update_fields=None, **kwargs):
+    """Keep the file name the row had before this save"""
+    field = MEDIA_FIELDS[sender]
+    if update_fields is not None and field not in update_fields:
+        instance._stored_file = UNCHANGED
+    elif instance._state.adding:
+        instance._stored_file = None
+    else:
+        instance._stored_file = sender.objects.filter(pk=instance.pk).values_list(field, flat=True).first()
+
+
+@receiver(post_save, sender=User)
+@receiver(post_save, sender=Message)
+@receiver(post_save, sender=Image)
+@receiver(post_save, sender=Upload)
+def count_file_references(sender, instance, **kwargs):
+    previous = getattr(instance, '_stored_file', UNCHANGED)
+    if previous is UNCHANGED:
+        return
+    current = getattr(instance, MEDIA_FIELDS[sender]).name or None
+    if current != (previous or None):
+        media.incref(current)
+        media.decref(previous)
+
+
+@receiver(post_delete, sender=User)
+@receiver(post_delete, sender=Message)
+@receiver(post_delete, sender=Image)
+@receiver(post_delete, sender=Upload)
+def release_stored_file(sender, instance, **kwargs):
+    media.decref(getattr(instance, MEDIA_FIELDS[sender]).name)
+
+
+@receiver(post_delete, sender=MessageArchive)
+def release_archived_files(sender, instance, **kwargs):
+    for name in instance.images:
+        media.decref(name)
@@ -0,0 +1,65 @@
+"""Content-addressed media storage.
+
+Avatars, message images, gallery images and chunked uploads are stored
+under the SHA-256 of their bytes (``cas/ab/cd/<sha256>.<ext>``). Saving bytes
+that are already stored only touches the file and returns the existing name,
+so a photo forwarded into many chats is kept once. Files are never
+overwritten; ``api.media`` counts references and deletes unused ones, unless
+they were touched after they lost their last reference.
+"""
+import hashlib
+import os
+import tempfile
+
+from django.core.files.storage import FileSystemStorage, storages
+
+EXTENSION_ALIASES = {'.jpeg': '.jpg'}
+
+
+def get_media_storage():
+    return storages['media']
+
+
+class ContentAddressedStorage(FileSystemStorage):
+    """FileSystemStorage that names files by their content hash"""
+
+    prefix = 'cas'
+
+    def get_available_name(self, name, max_length=None):
+        # Equal names mean equal bytes, so an existing file is never a clash.
+        return name
+
+    def content_name(self, name, digest):
+        ext = os.path.splitext(name)[1].lower()
+        ext = EXTENSION_ALIASES.get(ext, ext) if len(ext) <= 10 else ''
+        return f'{self.prefix}/{digest[:2]}/{digest[2:4]}/{digest}{ext}'
+
+    def _save(self, name, content):
+        digest = hashlib.sha256()
+        for chunk in content.chunks():
+            digest.update(chunk)
+        name = self.content_name(name, digest.hexdigest())
+
+        full_path = self.path(name)
+        try:
+            # Touching the stored copy tells garbage collection it is wanted again.
+            os.utime(full_path)
+            return name
+        except FileNotFoundError:
+            pass
+
+        directory = os.path.dirname(full_path)
+        os.makedirs(directory, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in content.chunks():
+                    f.write(chunk)
+            os.chmod(temp_path, self.file_permissions_mode or 0o644)
+            # Two writers of the same bytes may race here; either result is right.
+            os.replace(temp_path, full_path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        return name
@@ -0,0 +1,172 @@
+"""Incremental sync for reconnecting clients.
+
+Every change a chat list or an open chat cares about is appended to the
+``Change`` log by signals: messages created, edited or deleted, chats
+renamed, participants joining or leaving, and the caller's own read cursor
+moving. A log id is a monotonic cursor. A client keeps the cursor of its
+last sync and, after a reconnect, asks for what happened since then instead
+of fetching every chat and history again.
+
+On SQLite writers are serialized, so ids are handed out in commit order and
+the cursor is the id of the last entry seen; a cursor never skips an entry
+that commits later.
+
+PostgreSQL writers run concurrently, so an entry can commit after one with
+a higher id. There every entry carries the id of the transaction that wrote
+it (``txid_current()``) and the cursor is a transaction id instead: the
+entries of every transaction below it have been returned. A sync only
+returns entries of transactions below the snapshot's ``xmin``, all of which
+have finished, in transaction order, and never splits a transaction across
+pages. Writers take no lock.
+
+Entries older than ``settings.SYNC_RETENTION`` seconds are pruned. A cursor
+from before the oldest kept entry, or from after the newest one (a restored
+database), gets ``reset`` and the client falls back to a full fetch.
+"""
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import BigIntegerField, Func, Max, Min, Q
+from django.utils import timezone
+
+from .models import Change, Chat
+
+
+class CurrentTransactionId(Func):
+    function = 'txid_current'
+    output_field = BigIntegerField()
+
+
+def by_transaction():
+    """Whether the log is ordered by writing transaction rather than by id"""
+    return connection.vendor == 'postgresql'
+
+
+def snapshot():
+    """(xmin, xmax) of the current PostgreSQL snapshot: every transaction below xmin has finished, none from xmax on has started"""
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT txid_snapshot_xmin(s), txid_snapshot_xmax(s) FROM txid_current_snapshot() AS s'
+        )
+        return cursor.fetchone()
+
+
+def record(kind, chat_id, message_id=None, user_ids=None):
+    """Append one entry for the whole chat, or one per user for user_ids"""
+    txid = CurrentTransactionId() if by_transaction() else None
+    with transaction.atomic(savepoint=False):
+        if user_ids is None:
+            Change.objects.create(kind=kind, chat_id=chat_id, message_id=message_id, txid=txid)
+        elif user_ids:
+            Change.objects.bulk_create([
+                Change(kind=kind, chat_id=chat_id, message_id=message_id, user_id=user_id, txid=txid)
+                for user_id in user_ids
+            ])
+
+
+def record_messages(messages):
+    """Append the entries for messages created in bulk"""
+    txid = CurrentTransactionId() if by_transaction() else None
+    with transaction.atomic(savepoint=False):
+        Change.objects.bulk_create([
+            Change(kind=Change.MESSAGE, chat_id=message.chat_id, message_id=message.id, txid=txid)
+            for message in messages
+        ])
+
+
+def latest_cursor():
+    if by_transaction():
+        return snapshot()[0]
+    return Change.objects.aggregate(latest=Max('id'))['latest'] or 0
+
+
+def changes_since(user, cursor, limit):
+    """Up to limit entries after cursor that the user should see, the cursor after them, and whether more follow"""
+    member_chats = Chat.objects.filter(participants=user).values('id')
+    visible = Change.objects.filter(Q(user_id__isnull=True, chat_id__in=member_chats) | Q(user_id=user.id))
+    if by_transaction():
+        return _changes_by_transaction(visible, cursor, limit)
+    entries = list(visible.filter(id__gt=cursor).order_by('id')[:limit + 1])
+    page = entries[:limit]
+    return page, page[-1].id if page else cursor, len(entries) > limit
+
+
+def _changes_by_transaction(visible, cursor, limit):
+    horizon = snapshot()[0]
+    entries = list(visible.filter(txid__gte=cursor, txid__lt=horizon).order_by('txid', 'id')[:limit + 1])
+    page, next_cursor = whole_transactions(entries, limit)
+    if page is None:
+        # One transaction alone fills the page; return all of it.
+        txid = entries[0].txid
+        page = list(visible.filter(txid=txid).order_by('id'))
+        return page, txid + 1, True
+    if next_cursor is None:
+        return page, max(cursor, horizon), False
+    return page, next_cursor, True
+
+
+def whole_transactions(entries, limit):
+    """Cut up to limit + 1 entries ordered by (txid, id) to at most limit without splitting a transaction.
+
+    Returns the page and the cursor after it, which is None when nothing was
+    cut, or (None, None) when the first transaction has more than limit
+    entries.
+    """
+    if len(entries) <= limit:
+        return entries, None
+    cut = entries[limit].txid
+    page = [entry for entry in entries[:limit] if entry.txid != cut]
+    if not page:
+        return None, None
+    return page, cut
+
+
+def is_stale(cursor):
+    """Whether entries after cursor may have been pruned, or cursor is from another log"""
+    if by_transaction():
+        oldest = Change.objects.aggregate(oldest=Min('txid'))['oldest']
+        return cursor > snapshot()[1] or (oldest is not None and cursor < oldest)
+    bounds = Change.objects.aggregate(oldest=Min('id'), latest=Max('id'))
+    if cursor > (bounds['latest'] or 0):
+        return True
+    return bounds['oldest'] is not None and cursor < bounds['oldest'] - 1
+
+
+def collapse(user, entries):
+    """Reduce entries to what the client has to apply.
+
+    Returns (chat ids to refresh, chat ids the user left, message ids to
+    upsert, message ids to delete). Later entries win, and current
+    membership decides between refreshing and dropping a chat.
+    """
+    chats, left, messages, deleted = {}, set(), {}, set()
+    for entry in entries:
+        if entry.kind == Change.LEFT:
+            left.add(entry.chat_id)
+            chats.pop(entry.chat_id, None)
+        else:
+            chats[entry.chat_id] = None
+            left.discard(entry.chat_id)
+        if entry.kind == Change.MESSAGE:
+            messages[entry.message_id] = None
+            deleted.discard(entry.message_id)
+        elif entry.kind == Change.MESSAGE_DELETED:
+            messages.pop(entry.message_id, None)
+            deleted.add(entry.message_id)
+
+    member = set(
+        Chat.objects.filter(participants=user, id__in=set(chats) | left).values_list('id', flat=True)
+    )
+    return (
+        [chat_id for chat_id in chats if chat_id in member],
+        sorted(left - member),
+        list(messages),
+        sorted(deleted),
+    )
+
+
+def prune(retention=None):
+    """Delete entries older than retention seconds and return how many went"""
+    retention = settings.SYNC_RETENTION if retention is None else retention
+    return Change.objects.filter(created_at__lt=timezone.now() - timedelta(seconds=retention)).delete()[0]
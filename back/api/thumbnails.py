@@ -0,0 +1,170 @@
+"""Resized and recompressed variants of uploaded images.
+
+Avatars, message images and gallery images get one file per size in
+``settings.IMAGE_VARIANT_SIZES`` and per format in
+``settings.IMAGE_VARIANT_FORMATS``. The files are made on a small thread pool
+once the upload is committed, so requests never wait on Pillow. Until they
+exist, serializers fall back to the original file. The variant names are
+stored on the row as ``{"source": name, "64": {"webp": name, ...}, ...}``.
+
+Sources are content-addressed (``api.storage``), so variants live at fixed
+paths derived from the source name and are shared by every row storing the
+same image. They are deleted with their source by ``api.media``.
+"""
+import io
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import close_old_connections, transaction
+from PIL import Image as PILImage, ImageOps
+
+from .models import Image, Message, User
+from .profiles import invalidate_profiles
+from .storage import get_media_storage
+
+# model -> (image field, variants field)
+IMAGE_FIELDS = {
+    User: ('avatar', 'avatar_variants'),
+    Message: ('image', 'image_variants'),
+    Image: ('image', 'image_variants'),
+}
+
+SAVE_OPTIONS = {
+    'webp': {'format': 'WEBP', 'quality': 80, 'method': 4},
+    'jpeg': {'format': 'JPEG', 'quality': 82, 'optimize': True, 'progressive': True},
+}
+
+_executor = None
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=settings.IMAGE_VARIANT_WORKERS, thread_name_prefix='image-variants'
+        )
+    return _executor
+
+
+def render(source, size, fmt):
+    """Encode source scaled to fit in size x size; smaller images are only recompressed"""
+    image = source.copy()
+    image.thumbnail((size, size), PILImage.LANCZOS)
+    if fmt == 'jpeg' and image.mode != 'RGB':
+        background = PILImage.new('RGB', image.size, 'white')
+        rgba = image.convert('RGBA')
+        background.paste(rgba, mask=rgba.getchannel('A'))
+        image = background
+    elif image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGBA')
+    output = io.BytesIO()
+    image.save(output, **SAVE_OPTIONS[fmt])
+    return output.getvalue()
+
+
+def variant_directory(name):
+    return f'variants/{os.path.splitext(name)[0]}'
+
+
+def generate_variants(name):
+    """Write the variants of the stored image name that do not exist yet and return the variants dict"""
+    directory = variant_directory(name)
+    variants = {'source': name}
+    missing = []
+    for size in settings.IMAGE_VARIANT_SIZES:
+        variants[str(size)] = {}
+        for fmt in settings.IMAGE_VARIANT_FORMATS:
+            variant = variants[str(size)][fmt] = f'{directory}/{size}.{fmt}'
+            if not default_storage.exists(variant):
+                missing.append((size, fmt, variant))
+    if not missing:
+        return variants
+
+    with get_media_storage().open(name, 'rb') as f:
+        source = ImageOps.exif_transpose(PILImage.open(f))
+        source.load()
+    for size, fmt, variant in missing:
+        variants[str(size)][fmt] = default_storage.save(variant, ContentFile(render(source, size, fmt)))
+    return variants
+
+
+def variant_names(variants):
+    return [
+        name
+        for size, formats in (variants or {}).items() if size != 'source'
+        for name in formats.values()
+    ]
+
+
+def process(model, pk, name):
+    """Generate variants for one row, unless its image changed again in the meantime"""
+    close_old_connections()
+    try:
+        field, variants_field = IMAGE_FIELDS[model]
+        try:
+            variants = generate_variants(name)
+        except Exception as e:
+            print(f"Error generating variants for {name}: {e}")
+            return
+        if model.objects.filter(pk=pk, **{field: name}).update(**{variants_field: variants}) and model is User:
+            invalidate_profiles([pk])
+    finally:
+        close_old_connections()
+
+
+def schedule(instance):
+    """Queue variant generation for instance's image after the current transaction commits"""
+    model = type(instance)
+    field, variants_field = IMAGE_FIELDS[model]
+    name = getattr(instance, field).name
+    if not name:
+        if getattr(instance, variants_field):
+            model.objects.filter(pk=instance.pk).update(**{variants_field: None})
+            if model is User:
+                invalidate_profiles([instance.pk])
+        return
+
+    def submit():
+        if settings.IMAGE_VARIANT_WORKERS:
+            get_executor().submit(process, model, instance.pk, name)
+        else:
+            process(model, instance.pk, name)
+
+    transaction.on_commit(submit)
+
+
+def current_variants(file, variants):
+    """variants if they were made from the file now stored in the field"""
+    if file and variants and variants.get('source') == file.name:
+        return variants
+    return {}
+
+
+def variant_urls(file, variants, request=None):
+    """{size: {format: url}} for the generated variants; empty until they exist"""
+    urls = {}
+    for size, formats in current_variants(file, variants).items():
+        if size == 'source':
+            continue
+        urls[size] = {}
+        for fmt, name in formats.items():
+            url = default_storage.url(name)
+            urls[size][fmt] = request.build_absolute_uri(url) if request else url
+    return urls
+
+
+def image_url(file, variants, request=None, size=None, fmt='webp'):
+    """URL of the smallest variant at least size px wide, or of the original file"""
+    if not file:
+        return None
+    url = file.url
+    if size is not None:
+        current = current_variants(file, variants)
+        sizes = sorted(int(s) for s in current if s != 'source')
+        fitting = [s for s in sizes if s >= size] or sizes[-1:]
+        if fitting and fmt in current[str(fitting[0])]:
+            url = default_storage.url(current[str(fitting[0])][fmt])
+    return request.build_absolute_uri(url) if request else url
@@ -0,0 +1,132 @@
+"""Resumable uploads sent in chunks.
+
+A client announces the file (name, size, sha256), then PUTs it piece by piece
+with an ``Upload-Offset`` header. Each piece is copied from the request
+stream to a partial file in ``settings.UPLOAD_TEMP_DIR`` in small buffers, so
+memory stays bounded and no request lasts longer than one chunk. A client
+that lost its connection asks for the current offset and carries on from
+there. Completing checks the size and checksum and moves the bytes into
+storage; the stored file is then attached to a message or gallery image by
+passing the upload id as ``upload``.
+"""
+import hashlib
+import os
+
+from django.conf import settings
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.core.files import File
+from PIL import Image as PILImage
+from rest_framework.exceptions import ValidationError
+
+from .models import Upload
+
+BUFFER_SIZE = 64 * 1024
+
+
+class OffsetMismatch(Exception):
+    """The chunk does not start where the upload currently ends"""
+
+    def __init__(self, offset):
+        super().__init__(f"Upload is at offset {offset}")
+        self.offset = offset
+
+
+def partial_path(upload):
+    return os.path.join(settings.UPLOAD_TEMP_DIR, f'{upload.id}.part')
+
+
+def write_chunk(upload, offset, stream, length):
+    """Copy length bytes of stream to the upload at offset and return the new offset.
+
+    A connection that drops mid-chunk keeps what already arrived.
+    """
+    if upload.status != Upload.PENDING:
+        raise ValidationError('Upload is already complete.')
+    if offset != upload.received:
+        raise OffsetMismatch(upload.received)
+    if length > settings.UPLOAD_CHUNK_MAX_SIZE:
+        raise ValidationError(f'Chunks are limited to {settings.UPLOAD_CHUNK_MAX_SIZE} bytes.')
+    if offset + length > upload.size:
+        raise ValidationError('Chunk runs past the announced size.')
+
+    os.makedirs(settings.UPLOAD_TEMP_DIR, exist_ok=True)
+    path = partial_path(upload)
+    written = 0
+    with open(path, 'r+b' if os.path.exists(path) else 'wb') as f:
+        f.seek(offset)
+        f.truncate()
+        while written < length:
+            data = stream.read(min(BUFFER_SIZE, length - written)) if stream else b''
+            if not data:
+                break
+            f.write(data)
+            written += len(data)
+
+    # A concurrent chunk for the same offset loses here; the checksum on
+    # completion catches anything it may have left in the file.
+    updated = Upload.objects.filter(pk=upload.pk, received=offset).update(received=offset + written)
+    if not updated:
+        upload.refresh_from_db(fields=['received'])
+        raise OffsetMismatch(upload.received)
+    upload.received = offset + written
+    return upload.received
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(BUFFER_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def complete(upload):
+    """Verify the received bytes and move them into storage"""
+    if upload.status == Upload.COMPLETE:
+        return upload
+    if upload.received != upload.size:
+        raise ValidationError(f'Only {upload.received} of {upload.size} bytes received.')
+
+    path = partial_path(upload)
+    if not os.path.exists(path):
+        open(path, 'wb').close()
+    if file_sha256(path) != upload.sha256:
+        os.remove(path)
+        upload.received = 0
+        upload.save(update_fields=['received', 'updated_at'])
+        raise ValidationError('Checksum mismatch; send the file again from offset 0.')
+
+    with open(path, 'rb') as f:
+        upload.file.save(upload.filename, File(f), save=False)
+    os.remove(path)
+    upload.status = Upload.COMPLETE
+    upload.save(update_fields=['file', 'status', 'updated_at'])
+    return upload
+
+
+def discard(upload):
+    """Drop an upload with whatever it has stored so far"""
+    path = partial_path(upload)
+    if os.path.exists(path):
+        os.remove(path)
+    # The stored file may be shared; the garbage collector decides.
+    upload.delete()
+
+
+def claim(user, upload_id):
+    """Hand a completed image upload over to a new row and return its stored name"""
+    try:
+        upload = Upload.objects.get(id=upload_id, owner=user, status=Upload.COMPLETE)
+    except (Upload.DoesNotExist, DjangoValidationError, ValueError):
+        raise ValidationError({'upload': 'Unknown or incomplete upload.'})
+
+    try:
+        with upload.file.open('rb') as f:
+            PILImage.open(f).verify()
+    except Exception:
+        raise ValidationError({'upload': 'Upload is not an image.'})
+
+    # The file now belongs to the message or image; only the row goes.
+    name = upload.file.name
+    upload.delete()
+    return name
@@ -5,25 +5,21 @@ from rest_framework_simplejwt.views import (
     TokenRefreshView,
 )
 from .views import (
-    RegisterView,
-    UserViewSet, ChatViewSet, MessageViewSet, ImageViewSet
+    RegisterView, SyncView,
+    UserViewSet, ChatViewSet, MessageViewSet, ImageViewSet, UploadViewSet
 )
 
-from django.conf import settings
-from django.conf.urls.static import static
-
 router = DefaultRouter()
 router.register(r'users', UserViewSet)
 router.register(r'chats', ChatViewSet, basename='chat')
 router.register(r'messages', MessageViewSet, basename='message')
 router.register(r'images', ImageViewSet, basename='image')
+router.register(r'uploads', UploadViewSet, basename='upload')
 
 urlpatterns = [
     path('auth/register/', RegisterView.as_view(), name='register'),
     path('auth/login/', TokenObtainPairView.as_view(), name='jwt-login'),
     path('auth/refresh/', TokenRefreshView.as_view(), name='jwt-refresh'),
+    path('sync/', SyncView.as_view(), name='sync'),
     path('', include(router.urls)),
-]
-
-if settings.DEBUG:
-    urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
\ No newline at end of file
+]
\ No newline at end of file
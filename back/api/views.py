@@ -1,17 +1,25 @@
-from rest_framework import viewsets, generics, permissions, status, filters
+from rest_framework import viewsets, generics, mixins, permissions, status, filters
 from rest_framework.authtoken.views import ObtainAuthToken
 from rest_framework.authtoken.models import Token
 from rest_framework.response import Response
 from rest_framework.decorators import action
 from rest_framework.parsers import MultiPartParser
+from django.conf import settings
 from django.contrib.auth import get_user_model
-from django.db.models import Q
+from django.db import transaction
+from django.db.models import OuterRef, Q, Subquery
+from django.utils import timezone
+from django.http import Http404
 from django.core.exceptions import PermissionDenied
 
-from .models import Chat, Message, Image
+from . import outbox, profiles, realtime, replicas, sync, uploads
+from .models import Chat, ChatReadState, Message, Image, Upload
+from .pagination import MessageCursorPagination, MessageSearchPagination
+from .presence import get_shared_presence_registry, parse_user_ids
+from .search import TYPEAHEAD_LIMIT, MessageSearch, typeahead
 from .serializers import (
     RegisterSerializer, UserSerializer,
-    ChatSerializer, MessageSerializer, ImageSerializer
+    ChatSerializer, MessageSerializer, BulkMessageSerializer, ImageSerializer, UploadSerializer
 )
 
 User = get_user_model()
@@ -22,6 +30,21 @@ class RegisterView(generics.CreateAPIView):
     serializer_class = RegisterSerializer
 
 
+def chat_list_queryset(user):
+    """The user's chats with everything the chat list shows, newest activity first"""
+    unread_count = ChatReadState.objects.filter(
+        chat=OuterRef('pk'), user=user
+    ).values('unread_count')[:1]
+
+    return (
+        Chat.objects.filter(participants=user)
+        .select_related('last_message__sender')
+        .prefetch_related('participants')
+        .annotate(unread_count=Subquery(unread_count))
+        .order_by('-last_activity_at', '-id')
+    )
+
+
 class CustomAuthToken(ObtainAuthToken):
     def post(self, request, *args, **kwargs):
         response = super().post(request, *args, **kwargs)
@@ -33,7 +56,9 @@ class CustomAuthToken(ObtainAuthToken):
         })
 
 
-class UserViewSet(viewsets.ModelViewSet):
+class UserViewSet(replicas.ReplicaReadsMixin, viewsets.ModelViewSet):
+    # Profiles are cached, so they are built from the primary.
+    replica_actions = ('list', 'typeahead')
     queryset = User.objects.all()
     serializer_class = UserSerializer
     permission_classes = [permissions.IsAuthenticated]
@@ -58,7 +83,60 @@ class UserViewSet(viewsets.ModelViewSet):
             return self.request.user
             
         return super().get_object()
+
+    def cached_profile_response(self, kind, build, cache_control):
+        """Serve build(user) from the profile cache, or a 304 if the client already has it"""
+        lookup = self.kwargs.get('pk')
+        try:
+            user_id = int(self.request.user.pk if lookup == 'me' else lookup)
+        except (TypeError, ValueError):
+            raise Http404
+        etag, data = profiles.cached_profile(
+            kind, user_id, self.request.build_absolute_uri('/'), lambda: build(self.get_object())
+        )
+        headers = {'ETag': etag, 'Cache-Control': cache_control}
+        if profiles.etag_matches(self.request, etag):
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers=headers)
+        return Response(data, headers=headers)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.cached_profile_response(
+            profiles.PROFILE, lambda user: self.get_serializer(user).data, 'private, no-cache'
+        )
     
+    @action(detail=False, methods=['GET'])
+    def typeahead(self, request):
+        """Users whose username or email starts with q, the caller's contacts first"""
+        try:
+            limit = int(request.query_params.get('limit', TYPEAHEAD_LIMIT))
+        except ValueError:
+            limit = TYPEAHEAD_LIMIT
+        users = typeahead(request.user, request.query_params.get('q', ''), limit)
+        return Response(self.get_serializer(users, many=True).data)
+
+    @action(detail=False, methods=['GET', 'POST'])
+    def presence(self, request):
+        """Online status of many users, answered from the presence registry without touching the database.
+
+        When the socket server keeps presence to itself, the status it last
+        flushed to the database is returned instead, at version 0 so that any
+        status event overrides it.
+        """
+        if request.method == 'POST':
+            values = request.data.get('user_ids', [])
+        else:
+            values = [value for value in request.query_params.get('ids', '').split(',') if value]
+        try:
+            user_ids = parse_user_ids(values)
+        except ValueError as e:
+            return Response({'detail': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        registry = get_shared_presence_registry()
+        if registry is None:
+            stored = dict(User.objects.filter(id__in=user_ids).values_list('id', 'is_online'))
+            return Response({'users': {user_id: stored.get(user_id, False) for user_id in user_ids}, 'version': 0})
+        users, version = registry.snapshot(user_ids)
+        return Response({'users': users, 'version': version})
+
     @action(detail=True, methods=['POST'], parser_classes=[MultiPartParser])
     def upload_avatar(self, request, pk=None):
         user = self.get_object()
@@ -66,12 +144,7 @@ class UserViewSet(viewsets.ModelViewSet):
         if 'avatar' not in request.FILES:
             return Response({'error': 'No avatar file provided'}, status=status.HTTP_400_BAD_REQUEST)
         
-        if user.avatar:
-            import os
-            old_path = user.avatar.path
-            if os.path.isfile(old_path):
-                os.remove(old_path)
-        
+        # The old file may be shared with other rows; api.media deletes it once unused.
         user.avatar = request.FILES['avatar']
         user.save()
         
@@ -89,15 +162,6 @@ class UserViewSet(viewsets.ModelViewSet):
         data = request.data.copy() if hasattr(request.data, 'copy') else request.data
         
         if 'avatar' in request.FILES:
-            if instance.avatar:
-                try:
-                    import os
-                    old_path = instance.avatar.path
-                    if os.path.isfile(old_path):
-                        os.remove(old_path)
-                except (ValueError, OSError) as e:
-                    print(f"Error removing old avatar: {e}")
-            
             instance.avatar = request.FILES['avatar']
             instance.save()
             print(f"Avatar updated via update method for user {instance.id}. Path: {instance.avatar.path}")
@@ -115,23 +179,23 @@ class UserViewSet(viewsets.ModelViewSet):
     
     @action(detail=True, methods=['GET'], permission_classes=[permissions.AllowAny])
     def public_profile(self, request, pk=None):
-        user = self.get_object()
-        serializer = UserSerializer(user, context={'request': request})
-        data = {
-            'id': serializer.data['id'],
-            'username': serializer.data['username'],
-            'avatar_url': serializer.data['avatar_url'],
-            'is_online': serializer.data['is_online']
-        }
-        return Response(data)
+        def build(user):
+            serializer = UserSerializer(user, context={'request': request})
+            return {
+                'id': serializer.data['id'],
+                'username': serializer.data['username'],
+                'avatar_url': serializer.data['avatar_url'],
+                'is_online': serializer.data['is_online']
+            }
+        return self.cached_profile_response(profiles.PUBLIC_PROFILE, build, 'public, no-cache')
 
 
-class ChatViewSet(viewsets.ModelViewSet):
+class ChatViewSet(replicas.ReplicaReadsMixin, viewsets.ModelViewSet):
     serializer_class = ChatSerializer
     permission_classes = [permissions.IsAuthenticated]
 
     def get_queryset(self):
-        return Chat.objects.filter(participants=self.request.user)
+        return chat_list_queryset(self.request.user)
     
     def create(self, request, *args, **kwargs):
         print(f"Chat creation request received: {request.data}")
@@ -155,43 +219,119 @@ class ChatViewSet(viewsets.ModelViewSet):
         serializer = self.get_serializer(data=request.data)
         serializer.is_valid(raise_exception=True)
         
-        chat = serializer.save()
-        
-        participant_ids = set(participants_ids)
-        if request.user.id not in participant_ids:
-            chat.participants.add(request.user)
+        # The participants' room joins are queued with the chat, ahead of chat:created.
+        with transaction.atomic():
+            chat = serializer.save()
+            
+            participant_ids = set(participants_ids)
+            if request.user.id not in participant_ids:
+                chat.participants.add(request.user)
+            
+            for participant_id in participants_ids:
+                try:
+                    user = User.objects.get(id=participant_id)
+                    chat.participants.add(user)
+                except User.DoesNotExist:
+                    pass
+            
+            data = self.get_serializer(chat).data
+            outbox.enqueue('chat:created', data, room=realtime.chat_room(chat.id))
+        replicas.mark_written(*participant_ids)
         
-        for participant_id in participants_ids:
-            try:
-                user = User.objects.get(id=participant_id)
-                chat.participants.add(user)
-            except User.DoesNotExist:
-                pass
-        
-        return Response(
-            self.get_serializer(chat).data,
-            status=status.HTTP_201_CREATED
+        return Response(data, status=status.HTTP_201_CREATED)
+
+    @action(detail=True, methods=['POST'])
+    def read(self, request, pk=None):
+        chat = self.get_object()
+        message_id = request.data.get('message') or chat.last_message_id
+        if not message_id:
+            return Response({'unread_count': 0})
+
+        try:
+            message = Message.objects.get(id=message_id, chat=chat)
+        except (Message.DoesNotExist, ValueError, TypeError):
+            return Response({'error': 'Message not found in this chat'}, status=status.HTTP_400_BAD_REQUEST)
+
+        read_state, _ = ChatReadState.objects.get_or_create(chat=chat, user=request.user)
+        previous = read_state.last_read_message_id
+        with transaction.atomic():
+            read_state.mark_read(message)
+            # One UPDATE over the partial index of unread messages.
+            Message.objects.filter(Message.up_to(message), chat=chat, is_read=False).exclude(
+                sender=request.user
+            ).update(is_read=True)
+            if read_state.last_read_message_id != previous:
+                outbox.enqueue('messages:read', {
+                    'chat_id': chat.id,
+                    'user_id': request.user.id,
+                    'last_read_message': read_state.last_read_message_id,
+                }, room=realtime.chat_room(chat.id))
+        return Response({
+            'last_read_message': read_state.last_read_message_id,
+            'unread_count': read_state.unread_count,
+        })
+
+class SyncView(generics.GenericAPIView):
+    """What changed in the caller's chats since a cursor from an earlier sync"""
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get(self, request):
+        try:
+            limit = min(int(request.query_params.get('limit', settings.SYNC_PAGE_SIZE)), settings.SYNC_PAGE_SIZE)
+            cursor = request.query_params.get('cursor')
+            cursor = int(cursor) if cursor else None
+        except ValueError:
+            return Response({'error': 'cursor and limit must be integers'}, status=status.HTTP_400_BAD_REQUEST)
+
+        # Without a usable cursor the client fetches everything, then syncs from here.
+        if cursor is None or sync.is_stale(cursor):
+            return Response({'cursor': sync.latest_cursor(), 'reset': True, 'has_more': False})
+
+        entries, cursor, has_more = sync.changes_since(request.user, cursor, max(limit, 1))
+        chat_ids, left_chat_ids, message_ids, deleted_message_ids = sync.collapse(request.user, entries)
+        chats = chat_list_queryset(request.user).filter(id__in=chat_ids)
+        messages = (
+            Message.objects.select_related('sender')
+            .filter(id__in=message_ids, chat_id__in=chat_ids)
+            .order_by('id')
         )
+        context = {'request': request}
+        return Response({
+            'cursor': cursor,
+            'reset': False,
+            'has_more': has_more,
+            'chats': ChatSerializer(chats, many=True, context=context).data,
+            'left_chats': left_chat_ids,
+            'messages': MessageSerializer(messages, many=True, context=context).data,
+            'deleted_messages': deleted_message_ids,
+        })
 
-class MessageViewSet(viewsets.ModelViewSet):
+
+class MessageViewSet(replicas.ReplicaReadsMixin, viewsets.ModelViewSet):
+    replica_actions = ('list', 'retrieve', 'search')
     serializer_class = MessageSerializer
     permission_classes = [permissions.IsAuthenticated]
+    pagination_class = MessageCursorPagination
+
+    # Set for chat-scoped requests, so history pages read through into the archive.
+    archive_chat_id = None
 
     def get_queryset(self):
         chat_id = self.request.query_params.get('chat', None)
-        queryset = Message.objects.all()
+        queryset = Message.objects.select_related('sender')
         
         if chat_id:
             try:
                 chat = Chat.objects.get(id=chat_id, participants=self.request.user)
                 queryset = queryset.filter(chat=chat)
+                self.archive_chat_id = chat.id
             except Chat.DoesNotExist:
                 return Message.objects.none()
         else:
             user_chats = Chat.objects.filter(participants=self.request.user)
             queryset = queryset.filter(chat__in=user_chats)
             
-        return queryset.order_by('sent_at')
+        return queryset.order_by('sent_at', 'id')
     
     def perform_create(self, serializer):
         chat_id = serializer.validated_data.get('chat').id
@@ -201,7 +341,77 @@ class MessageViewSet(viewsets.ModelViewSet):
         except Chat.DoesNotExist:
             raise PermissionDenied("You are not a participant in this chat.")
         
-        serializer.save(sender=self.request.user)
+        outbox.check_backlog()
+        with transaction.atomic():
+            message = serializer.save(sender=self.request.user)
+            chat.record_message(message)
+            outbox.enqueue('message:created', MessageSerializer(message).data, room=realtime.chat_room(chat.id))
+
+    @action(detail=False, methods=['POST'])
+    def bulk(self, request):
+        """Create many messages in one chat with a single INSERT and announce them in batches"""
+        serializer = BulkMessageSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        chat = serializer.validated_data['chat']
+        items = serializer.validated_data['messages']
+
+        participant_ids = set(chat.participants.values_list('id', flat=True))
+        if request.user.id not in participant_ids:
+            raise PermissionDenied("You are not a participant in this chat.")
+        if not request.user.is_staff and any('sender' in item or 'sent_at' in item for item in items):
+            raise PermissionDenied("Only staff can import messages with a sender or timestamp.")
+        sender_ids = {item.get('sender', request.user.id) for item in items}
+        if not sender_ids <= participant_ids:
+            return Response({'error': 'Every sender must be a participant in the chat'}, status=status.HTTP_400_BAD_REQUEST)
+        senders = User.objects.in_bulk(sender_ids)
+
+        now = timezone.now()
+        messages = sorted((
+            Message(
+                chat=chat,
+                sender=senders[item.get('sender', request.user.id)],
+                text=item['text'],
+                sent_at=item.get('sent_at', now),
+            )
+            for item in items
+        ), key=lambda message: message.sent_at)
+        outbox.check_backlog()
+        with transaction.atomic():
+            Message.objects.bulk_create(messages)
+            chat.record_messages(messages)
+            sync.record_messages(messages)
+            data = MessageSerializer(messages, many=True).data
+            size = settings.MESSAGE_EVENT_BATCH_SIZE
+            outbox.enqueue_many(
+                'messages:created', [data[start:start + size] for start in range(0, len(data), size)],
+                room=realtime.chat_room(chat.id),
+            )
+
+        return Response(MessageSerializer(messages, many=True, context={'request': request}).data,
+                        status=status.HTTP_201_CREATED)
+
+    @action(detail=False, methods=['GET'])
+    def search(self, request):
+        """Full-text search over the messages of the caller's chats, best matches first.
+
+        Archived messages, older than settings.MESSAGE_ARCHIVE_AFTER, are not searched.
+        Only the newest MessageSearch.max_candidates matches are ranked; the
+        response's ``truncated`` says when older ones were left out.
+        """
+        query = request.query_params.get('q', '').strip()
+        if not query:
+            return Response({'error': 'Query parameter q is required'}, status=status.HTTP_400_BAD_REQUEST)
+
+        chat_id = request.query_params.get('chat')
+        try:
+            chat_id = int(chat_id) if chat_id else None
+        except ValueError:
+            return Response({'error': 'Invalid chat id'}, status=status.HTTP_400_BAD_REQUEST)
+
+        paginator = MessageSearchPagination()
+        page = paginator.paginate_queryset(MessageSearch(request.user, query, chat_id), request, view=self)
+        serializer = self.get_serializer(page, many=True)
+        return paginator.get_paginated_response(serializer.data)
 
 
 class ImageViewSet(viewsets.ModelViewSet):
@@ -213,4 +423,43 @@ class ImageViewSet(viewsets.ModelViewSet):
         return Image.objects.filter(uploader=self.request.user)
     
     def perform_create(self, serializer):
-        serializer.save(uploader=self.request.user)
\ No newline at end of file
+        # A failed save gives a claimed upload back.
+        with transaction.atomic():
+            serializer.save(uploader=self.request.user)
+
+
+class UploadViewSet(mixins.CreateModelMixin, mixins.RetrieveModelMixin,
+                    mixins.DestroyModelMixin, viewsets.GenericViewSet):
+    """Resumable chunked uploads: announce, PUT chunks, complete, then attach as `upload`"""
+    serializer_class = UploadSerializer
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get_queryset(self):
+        return Upload.objects.filter(owner=self.request.user)
+
+    def perform_create(self, serializer):
+        serializer.save(owner=self.request.user)
+
+    def perform_destroy(self, instance):
+        uploads.discard(instance)
+
+    @action(detail=True, methods=['PUT'], parser_classes=[])
+    def chunk(self, request, pk=None):
+        """Raw chunk bytes in the body, starting at the Upload-Offset header"""
+        upload = self.get_object()
+        try:
+            offset = int(request.headers['Upload-Offset'])
+            length = int(request.headers.get('Content-Length') or 0)
+        except (KeyError, ValueError):
+            return Response({'error': 'Upload-Offset header is required'}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            uploads.write_chunk(upload, offset, request.stream, length)
+        except uploads.OffsetMismatch as e:
+            return Response({'error': str(e), 'offset': e.offset}, status=status.HTTP_409_CONFLICT)
+        return Response(self.get_serializer(upload).data)
+
+    @action(detail=True, methods=['POST'])
+    def complete(self, request, pk=None):
+        upload = uploads.complete(self.get_object())
+        return Response(self.get_serializer(upload).data)
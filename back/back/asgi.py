@@ -2,6 +2,8 @@
 ASGI config for back project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
+Socket.IO traffic under ``/socket.io/`` goes to the async socket server, and
+everything else to Django.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/4.2/howto/deployment/asgi/
@@ -9,8 +11,18 @@ https://docs.djangoproject.com/en/4.2/howto/deployment/asgi/
 
 import os
 
+import socketio
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'back.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+from socket_server import sio, start_background_tasks, stop_background_tasks  # noqa: E402
+
+application = socketio.ASGIApp(
+    sio,
+    other_asgi_app=django_application,
+    on_startup=start_background_tasks,
+    on_shutdown=stop_background_tasks,
+)
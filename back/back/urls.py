@@ -4,7 +4,7 @@ from django.contrib import admin
 from django.urls import path, include, re_path
 from rest_framework import permissions
 from django.conf import settings
-from django.conf.urls.static import static
+from api.mediaserve import serve_media
 
 schema_view = get_schema_view(
     openapi.Info(
@@ -26,7 +26,5 @@ urlpatterns = [
             schema_view.without_ui(cache_timeout=0), name='schema-json'),
     path('swagger/', schema_view.with_ui('swagger', cache_timeout=0), name='schema-swagger-ui'),
     path('redoc/', schema_view.with_ui('redoc', cache_timeout=0), name='schema-redoc'),
-]
-
-if settings.DEBUG:
-    urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
\ No newline at end of file
+    re_path(rf"^{settings.MEDIA_URL.lstrip('/')}(?P<path>.*)$", serve_media, name='media'),
+]
\ No newline at end of file
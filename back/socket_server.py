@@ -1,227 +1,459 @@
+import asyncio
+import functools
+import math
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 import django
 import socketio
 import jwt
 from django.conf import settings
-from django.contrib.auth import get_user_model
-from datetime import timedelta
+from django.core.exceptions import PermissionDenied
+from django.db import close_old_connections, transaction
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "back.settings")
 django.setup()
 
 from api.models import Chat, Message, User
+from api import archive, media, outbox, realtime, replicas, sync, uploads
+from api.presence import IdleTimer, PresenceBuffer, get_presence_registry, parse_user_ids
+from api.pubsub import get_client_manager
+from api.realtime import chat_room, presence_room
+from api.search import typeahead
 from api.serializers import ChatSerializer, MessageSerializer, UserSerializer
 
-sio = socketio.Server(cors_allowed_origins="*")
-app = socketio.WSGIApp(sio)
+sio = socketio.AsyncServer(
+    async_mode="asgi", cors_allowed_origins="*", client_manager=get_client_manager()
+)
+
+presence = get_presence_registry()
+presence_buffer = PresenceBuffer(debounce=settings.PRESENCE_DEBOUNCE)
+idle_timer = IdleTimer(timeout=settings.SOCKET_IDLE_TIMEOUT)
+pending_logins = {}
+background_tasks = []
+
+# Every ORM call runs here so a slow query only holds one worker thread,
+# never the event loop that serves all the connections.
+db_executor = ThreadPoolExecutor(
+    max_workers=settings.SOCKET_DB_WORKERS, thread_name_prefix="socket-db"
+)
+
+
+def _run_in_db_thread(fn, *args, **kwargs):
+    close_old_connections()
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        close_old_connections()
+
 
-connected_users = {}
+async def run_db(fn, *args, **kwargs):
+    """Run blocking ORM work on the bounded DB thread pool"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        db_executor, functools.partial(_run_in_db_thread, fn, *args, **kwargs)
+    )
 
-def get_user_from_token(token):
+
+async def run_presence(fn, *args):
+    """Call the presence registry off the event loop, as with Redis every call is a round trip"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, functools.partial(fn, *args))
+
+
+def decode_token(token):
     try:
-        payload = jwt.decode(token, settings.SECRET_KEY, algorithms=["HS256"])
-        user = User.objects.get(id=payload["user_id"])
-        return user
+        return jwt.decode(token, settings.SECRET_KEY, algorithms=["HS256"])
     except Exception as e:
         print(f"Error decoding token: {e}")
         return None
 
+
+def get_user(user_id):
+    return User.objects.filter(id=user_id).first()
+
+
+def get_user_rooms(user_id):
+    """Rooms for the user's chats and for the presence of everyone sharing a chat with them"""
+    chat_ids = list(Chat.objects.filter(participants=user_id).values_list("id", flat=True))
+    contact_ids = set(
+        User.objects.filter(chats__participants=user_id)
+        .exclude(id=user_id)
+        .values_list("id", flat=True)
+    )
+    return [chat_room(chat_id) for chat_id in chat_ids] + [
+        presence_room(contact_id) for contact_id in contact_ids
+    ]
+
+
+def is_participant(user_id, chat_id):
+    return Chat.objects.filter(id=chat_id, participants=user_id).exists()
+
+
+def create_chat(user, participants_ids, chat_name, is_group):
+    """Store a chat; the outbox dispatchers join its rooms and announce it"""
+    with transaction.atomic():
+        chat = Chat.objects.create(name=chat_name, is_group=is_group)
+
+        user_ids = list(set(participants_ids + [user.id]))
+        chat.participants.set(User.objects.filter(id__in=user_ids))
+        outbox.enqueue("chat:created", ChatSerializer(chat).data, room=chat_room(chat.id))
+    replicas.mark_written(*user_ids)
+
+
+def create_message(user, chat_id, text, upload_id=None):
+    """Store a message; the outbox dispatchers announce it to the chat"""
+    chat = Chat.objects.get(id=chat_id)
+    outbox.check_backlog()
+
+    with transaction.atomic():
+        # The socket may still be in the room of a chat the user has just left.
+        if not chat.participants.filter(id=user.id).exists():
+            raise PermissionDenied("You are not a participant in this chat")
+        image = uploads.claim(user, upload_id) if upload_id else None
+        message = Message.objects.create(chat=chat, sender=user, text=text, image=image)
+        chat.record_message(message)
+        outbox.enqueue("message:created", MessageSerializer(message).data, room=chat_room(chat.id))
+    replicas.mark_written(user.id)
+
+
+def find_users(user, search_term):
+    with replicas.reads(user.id):
+        return UserSerializer(typeahead(user, search_term), many=True).data
+
+
 def broadcast_user_status(user_id, is_online):
-    """Broadcast user online status to all relevant users"""
-    user = User.objects.get(id=user_id)
-    
-    user_chats = Chat.objects.filter(participants=user)
-    
-    contact_ids = set()
-    for chat in user_chats:
-        for participant in chat.participants.all():
-            if participant.id != user_id:  # Don't include the user themselves
-                contact_ids.add(participant.id)
-    
-    user.is_online = is_online
-    user.save()
-    
-    for contact_id in contact_ids:
-        if contact_id in connected_users:
-            contact_sid = connected_users[contact_id]['sid']
-            sio.emit("user_status_changed", {
-                "user_id": user_id,
-                "is_online": is_online
-            }, to=contact_sid)
+    """Queue a status change for the next presence flush"""
+    presence_buffer.mark(user_id, is_online)
+
+
+async def flush_presence(settle_all=False):
+    """Write settled presence changes in bulk, then tell each user's contacts"""
+    changes, active_ids = presence_buffer.drain(now=math.inf if settle_all else None)
+    if not changes and not active_ids:
+        return
+
+    try:
+        if changes:
+            # A user who left this node may be connected to another one by now.
+            online = await run_presence(presence.online, changes)
+            changes = {user_id: user_id in online for user_id in changes}
+        changes = await run_db(User.save_presence, changes, active_ids)
+    except Exception:
+        presence_buffer.restore(changes, active_ids)
+        raise
+
+    version = await run_presence(presence.version)
+    for user_id, is_online in changes.items():
+        await sio.emit("user_status_changed", {
+            "user_id": user_id,
+            "is_online": is_online,
+            "version": version
+        }, room=presence_room(user_id))
+
+
+async def flush_presence_periodically():
+    while True:
+        await sio.sleep(settings.PRESENCE_FLUSH_INTERVAL)
+        try:
+            await flush_presence()
+        except Exception as e:
+            print(f"Error flushing presence: {e}")
+
+
+async def collect_media_periodically():
+    """Delete media files that stayed unreferenced past the grace period"""
+    while True:
+        await sio.sleep(settings.MEDIA_GC_INTERVAL)
+        try:
+            await run_db(media.collect_garbage)
+        except Exception as e:
+            print(f"Error collecting media: {e}")
+
+
+async def archive_messages_periodically():
+    """Move old messages to the archive, keeping the message table small"""
+    while True:
+        await sio.sleep(settings.MESSAGE_ARCHIVE_INTERVAL)
+        try:
+            await run_db(archive.archive_messages)
+        except Exception as e:
+            print(f"Error archiving messages: {e}")
+
+
+async def prune_sync_log_periodically():
+    while True:
+        await sio.sleep(settings.SYNC_PRUNE_INTERVAL)
+        try:
+            await run_db(sync.prune)
+        except Exception as e:
+            print(f"Error pruning the sync log: {e}")
+
+
+async def apply_room_event(event):
+    """Move the open sockets of a queued membership change in or out of rooms"""
+    data = event.payload
+    if event.event == realtime.JOIN_CHAT:
+        pairs = await run_presence(realtime.chat_memberships, data["chat_id"], data["user_ids"], None, data["member_ids"])
+        for sid, room in pairs:
+            await sio.enter_room(sid, room)
+    else:
+        for sid, room in await run_presence(realtime.chat_departures, data["chat_id"], data["user_ids"]):
+            await sio.leave_room(sid, room)
+
+
+async def dispatch_outbox(shards, wakeup):
+    """Emit queued outbox events of shards in write order, then delete them"""
+    while True:
+        try:
+            events = await run_db(outbox.claim, shards)
+        except Exception as e:
+            print(f"Error claiming outbox events: {e}")
+            await sio.sleep(settings.OUTBOX_POLL_INTERVAL)
+            continue
+        if not events:
+            wakeup.clear()
+            try:
+                await asyncio.wait_for(wakeup.wait(), settings.OUTBOX_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            continue
+        try:
+            for event in events:
+                if event.event in realtime.ROOM_EVENTS:
+                    await apply_room_event(event)
+                else:
+                    await sio.emit(event.event, event.payload, room=event.room)
+            await run_db(outbox.complete, events)
+        except Exception as e:
+            print(f"Error dispatching outbox events: {e}")
+            try:
+                await run_db(outbox.release, events)
+            except Exception as e:
+                # The lease runs out on its own and the events are claimed again.
+                print(f"Error releasing outbox events: {e}")
+            await sio.sleep(settings.OUTBOX_POLL_INTERVAL)
+
+
+async def check_participant(sid, user_id, chat_id):
+    """Membership from the connection's rooms, falling back to the database once"""
+    if chat_room(chat_id) in sio.rooms(sid):
+        return True
+    if await run_db(is_participant, user_id, chat_id):
+        await sio.enter_room(sid, chat_room(chat_id))
+        return True
+    return False
+
+async def login(sid, token):
+    """Resolve the token once and keep the user in the Socket.IO session"""
+    task = pending_logins.get(sid)
+    if task is None:
+        task = pending_logins[sid] = asyncio.ensure_future(_login(sid, token))
+        task.add_done_callback(lambda _: pending_logins.pop(sid, None))
+    return await task
+
+
+async def _login(sid, token):
+    payload = decode_token(token) if token else None
+    user = await run_db(get_user, payload["user_id"]) if payload else None
+    if not user:
+        await sio.emit("auth_error", {"message": "Invalid token"}, to=sid)
+        return None
+
+    await sio.save_session(sid, {"user": user, "expires_at": payload.get("exp")})
+
+    first_connection = await run_presence(presence.connect, user.id, sid)
+    idle_timer.add(sid)
+
+    for room in await run_db(get_user_rooms, user.id):
+        await sio.enter_room(sid, room)
+
+    # Other devices of the same user keep their connections; contacts only
+    # hear about the first one.
+    if first_connection:
+        broadcast_user_status(user.id, True)
+
+    await sio.emit("auth_success", {"user_id": user.id}, to=sid)
+    return user
+
+
+async def get_session_user(sid, data=None):
+    """Return the user authenticated on this connection.
+
+    Clients that send an event before (or instead of) ``auth`` are logged in
+    from the token in the payload. Expiry is only checked here, lazily.
+    """
+    session = await sio.get_session(sid)
+    user = session.get("user")
+    if user is None:
+        token = data.get("token") if isinstance(data, dict) else None
+        return await login(sid, token) if token else None
+
+    expires_at = session.get("expires_at")
+    if expires_at is not None and expires_at <= time.time():
+        # The connection stays open but no longer belongs to the user.
+        await sio.save_session(sid, {})
+        for room in sio.rooms(sid):
+            if room != sid:
+                await sio.leave_room(sid, room)
+        await release_connection(sid)
+        await sio.emit("auth_error", {"message": "Token expired"}, to=sid)
+        return None
+
+    return user
+
+
+async def release_connection(sid):
+    """Take the connection out of the idle timer and presence, announcing the user's last one"""
+    idle_timer.remove(sid)
+    user_id, last_connection = await run_presence(presence.disconnect, sid)
+    if last_connection:
+        broadcast_user_status(user_id, False)
 
 @sio.event
-def connect(sid, environ):
+async def connect(sid, environ, auth=None):
     print(f"Connected: {sid}")
+    if auth and auth.get("token"):
+        await login(sid, auth["token"])
 
 @sio.event
-def disconnect(sid):
+async def disconnect(sid):
     print(f"Disconnected: {sid}")
-    user_id = None
-    
-    for uid, data in connected_users.items():
-        if data['sid'] == sid:
-            user_id = uid
-            del connected_users[uid]
-            break
-    
-    if user_id:
-        broadcast_user_status(user_id, False)
+    await release_connection(sid)
 
 @sio.event
-def auth(sid, data):
-    token = data.get("token")
-    user = get_user_from_token(token)
-    
-    if user:
-        if user.id in connected_users:
-            old_sid = connected_users[user.id]['sid']
-            if old_sid != sid:
-                sio.disconnect(old_sid)
-        
-        connected_users[user.id] = {
-            'sid': sid,
-            'last_active': django.utils.timezone.now()
-        }
-        
-        broadcast_user_status(user.id, True)
-        
-        sio.emit("auth_success", {"user_id": user.id}, to=sid)
-    else:
-        sio.emit("auth_error", {"message": "Invalid token"}, to=sid)
+async def auth(sid, data):
+    await login(sid, data.get("token"))
 
 @sio.event
-def chat_create(sid, data):
-    user = get_user_from_token(data.get("token"))
+async def chat_create(sid, data):
+    user = await get_session_user(sid, data)
     if not user:
-        return sio.emit("error", {"message": "Unauthorized"}, to=sid)
+        return await sio.emit("error", {"message": "Unauthorized"}, to=sid)
 
     participants_ids = data.get("participants", [])
     chat_name = data.get("name", "")
     is_group = data.get("is_group", False)
-    
-    chat = Chat.objects.create(name=chat_name, is_group=is_group)
-    
-    user_ids = list(set(participants_ids + [user.id]))
-    chat.participants.set(User.objects.filter(id__in=user_ids))
-    
-    serializer = ChatSerializer(chat)
-    
-    for uid in user_ids:
-        if uid in connected_users:
-            sio.emit("chat:created", serializer.data, to=connected_users[uid]['sid'])
+
+    await run_db(create_chat, user, participants_ids, chat_name, is_group)
 
 @sio.event
-def message_create(sid, data):
-    user = get_user_from_token(data.get("token"))
+async def message_create(sid, data):
+    user = await get_session_user(sid, data)
     if not user:
-        return sio.emit("error", {"message": "Unauthorized"}, to=sid)
+        return await sio.emit("error", {"message": "Unauthorized"}, to=sid)
 
     chat_id = data.get("chat_id")
     text = data.get("text")
-    
+    upload_id = data.get("upload")
+
     try:
-        chat = Chat.objects.get(id=chat_id)
-        if not chat.participants.filter(id=user.id).exists():
-            return sio.emit("error", {"message": "You are not a participant in this chat"}, to=sid)
-        
-        message = Message.objects.create(chat=chat, sender=user, text=text)
-        serializer = MessageSerializer(message)
-        
-        for participant in chat.participants.all():
-            if participant.id in connected_users:
-                sio.emit("message:created", serializer.data, to=connected_users[participant.id]['sid'])
-        
-        if user.id in connected_users:
-            connected_users[user.id]['last_active'] = django.utils.timezone.now()
-        
+        if not await check_participant(sid, user.id, chat_id):
+            return await sio.emit("error", {"message": "You are not a participant in this chat"}, to=sid)
+
+        await run_db(create_message, user, chat_id, text, upload_id)
+
+        idle_timer.touch(sid)
+        presence_buffer.touch(user.id)
+
     except Chat.DoesNotExist:
-        sio.emit("error", {"message": "Chat not found"}, to=sid)
+        await sio.emit("error", {"message": "Chat not found"}, to=sid)
     except Exception as e:
-        sio.emit("error", {"message": str(e)}, to=sid)
+        await sio.emit("error", {"message": str(e)}, to=sid)
 
 @sio.event
-def get_online_users(sid, data):
-    """Get online status of specific users"""
-    user = get_user_from_token(data.get("token"))
+async def get_online_users(sid, data):
+    """Online status of many users from the presence registry, with its version"""
+    user = await get_session_user(sid, data)
     if not user:
-        return sio.emit("error", {"message": "Unauthorized"}, to=sid)
-    
-    user_ids = data.get("user_ids", [])
+        return await sio.emit("error", {"message": "Unauthorized"}, to=sid)
+
+    try:
+        user_ids = parse_user_ids(data.get("user_ids", []))
+    except ValueError as e:
+        return await sio.emit("error", {"message": str(e)}, to=sid)
     if not user_ids:
         return
-    
-    online_users = {}
-    for uid in user_ids:
-        try:
-            status_user = User.objects.get(id=uid)
-            is_online = uid in connected_users
-            online_users[uid] = is_online
-            
-            if status_user.is_online != is_online:
-                status_user.is_online = is_online
-                status_user.save()
-        except User.DoesNotExist:
-            online_users[uid] = False
-    
-    sio.emit("online_users", online_users, to=sid)
+
+    users, version = await run_presence(presence.snapshot, user_ids)
+    await sio.emit("online_users", {"users": users, "version": version}, to=sid)
 
 @sio.event
-def search_users(sid, data):
-    user = get_user_from_token(data.get("token"))
+async def search_users(sid, data):
+    user = await get_session_user(sid, data)
     if not user:
-        return sio.emit("error", {"message": "Unauthorized"}, to=sid)
-    
+        return await sio.emit("error", {"message": "Unauthorized"}, to=sid)
+
     search_term = data.get("search", "")
     if not search_term or len(search_term) < 1:
-        return sio.emit("search_results", {"users": []}, to=sid)
-    
-    from django.db.models import Q
-    search_results = User.objects.filter(
-        Q(username__icontains=search_term) | 
-        Q(email__icontains=search_term)
-    ).exclude(id=user.id)[:20]
-    
-    serializer = UserSerializer(search_results, many=True)
-    sio.emit("search_results", {"users": serializer.data}, to=sid)
+        return await sio.emit("search_results", {"users": []}, to=sid)
+
+    users = await run_db(find_users, user, search_term)
+    await sio.emit("search_results", {"users": users}, to=sid)
 
 @sio.event
-def heartbeat(sid, data):
+async def heartbeat(sid, data):
     """Update user's last active time to keep track of active users"""
-    user = get_user_from_token(data.get("token"))
-    if user and user.id in connected_users:
-        connected_users[user.id]['last_active'] = django.utils.timezone.now()
-        if not user.is_online:
-            user.is_online = True
-            user.save()
+    user = await get_session_user(sid, data)
+    if user and await run_presence(presence.get_user, sid) == user.id:
+        idle_timer.touch(sid)
+        presence_buffer.touch(user.id)
+
+
+async def check_inactive_users():
+    """Disconnect this node's idle connections; their users go offline in the next presence flush"""
+    while True:
+        await sio.sleep(settings.SOCKET_IDLE_CHECK_INTERVAL)
+        try:
+            for user_sid in idle_timer.expired():
+                user_id, last_connection = await run_presence(presence.disconnect, user_sid)
+                if last_connection:
+                    broadcast_user_status(user_id, False)
+                await sio.disconnect(user_sid)
+        except Exception as e:
+            print(f"Error in inactive users check: {e}")
+
+
+def start_background_tasks():
+    loop = asyncio.get_running_loop()
+    dispatchers = settings.OUTBOX_DISPATCHERS
+    wakeups = [asyncio.Event() for _ in range(dispatchers)]
+
+    def wake_dispatchers():
+        for wakeup in wakeups:
+            wakeup.set()
+
+    def start(target, *args):
+        background_tasks.append(sio.start_background_task(target, *args))
+
+    outbox.on_enqueue(lambda: loop.call_soon_threadsafe(wake_dispatchers))
+    for i, wakeup in enumerate(wakeups):
+        shards = [shard for shard in range(settings.OUTBOX_SHARDS) if shard % dispatchers == i]
+        start(dispatch_outbox, shards, wakeup)
+    start(check_inactive_users)
+    start(flush_presence_periodically)
+    if settings.MEDIA_GC_INTERVAL:
+        start(collect_media_periodically)
+    start(prune_sync_log_periodically)
+    if settings.MESSAGE_ARCHIVE_INTERVAL:
+        start(archive_messages_periodically)
+
+
+async def stop_background_tasks():
+    """Stop the tasks started above, then settle this node's presence"""
+    outbox.on_enqueue(None)
+    for task in background_tasks:
+        task.cancel()
+    # Events a cancelled dispatcher had claimed are claimed again once their lease runs out.
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    background_tasks.clear()
+    await flush_presence(settle_all=True)
+
+
+app = socketio.ASGIApp(sio, on_startup=start_background_tasks, on_shutdown=stop_background_tasks)
 
 if __name__ == '__main__':
-    import eventlet
-    import eventlet.wsgi
-    
-    def check_inactive_users():
-        while True:
-            try:
-                now = django.utils.timezone.now()
-                inactive_threshold = now - timedelta(minutes=5)
-            
-                for user_id, data in list(connected_users.items()):
-                    if data['last_active'] < inactive_threshold:
-                        sio.disconnect(data['sid'])
-                        del connected_users[user_id]
-                        
-                        try:
-                            user = User.objects.get(id=user_id)
-                            if user.is_online:
-                                user.is_online = False
-                                user.save()
-                                broadcast_user_status(user_id, False)
-                        except User.DoesNotExist:
-                            pass
-            except Exception as e:
-                print(f"Error in inactive users check: {e}")
-            
-            eventlet.sleep(60)
-    
-    eventlet.spawn(check_inactive_users)
-    
-    eventlet.wsgi.server(eventlet.listen(('0.0.0.0', 5000)), app)
\ No newline at end of file
+    import uvicorn
+
+    uvicorn.run(app, host='0.0.0.0', port=5000)
@@ -223,8 +223,8 @@ export class UserSearchComponent implements OnInit {
       'Authorization': `Bearer ${token}`
     });
     
-    // Assuming your API supports searching users with a query parameter
-    this.http.get<User[]>(`${this.apiUrl}/users/?search=${this.searchTerm}`, { headers })
+    // Prefix search; people already chatted with come first
+    this.http.get<User[]>(`${this.apiUrl}/users/typeahead/`, { headers, params: { q: this.searchTerm } })
       .subscribe({
         next: (users) => {
           // Filter out the current user
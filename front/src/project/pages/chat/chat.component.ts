@@ -21,6 +21,12 @@ interface ChatMessage {
   sender_username?: string;
 }
 
+interface MessagePage {
+  next: string | null;
+  previous: string | null;
+  results: ChatMessage[];
+}
+
 interface Chat {
   id: number;
   name: string;
@@ -82,9 +88,10 @@ loadMessages(chatId: number): void {
     'Authorization': `Bearer ${token}`
   });
 
-  this.http.get<ChatMessage[]>(`${this.apiUrl}/messages/?chat=${chatId}`, { headers })
+  this.http.get<MessagePage>(`${this.apiUrl}/messages/?chat=${chatId}`, { headers })
     .subscribe({
-      next: (messages) => {
+      next: (page) => {
+        const messages = page.results;
         this.messages = messages;
         console.log('Messages loaded:', messages);
       },
@@ -165,8 +172,9 @@ loadMessages(chatId: number): void {
       (message) => {
         console.log('New message received from WebSocket:', message);
         
-        // Add message to current chat if it matches
-        if (this.selectedChat && message.chat === this.selectedChat.id) {
+        // Add message to current chat if it matches; events may arrive more than once
+        if (this.selectedChat && message.chat === this.selectedChat.id
+            && !this.messages.some(m => m.id === message.id)) {
           this.messages.push(message);
         }
         
@@ -393,7 +401,9 @@ loadMessages(chatId: number): void {
       this.http.post<ChatMessage>(`${this.apiUrl}/messages/`, messageData, { headers })
         .subscribe({
           next: (message) => {
-            this.messages.push(message);
+            if (!this.messages.some(m => m.id === message.id)) {
+              this.messages.push(message);
+            }
             this.newMessage = '';
             console.log('Message sent via HTTP:', message);
           },
@@ -483,7 +493,9 @@ loadMessages(chatId: number): void {
       .subscribe({
         next: (chat) => {
           console.log('Chat created successfully:', chat);
-          this.chats.unshift(chat);
+          if (!this.chats.some(c => c.id === chat.id)) {
+            this.chats.unshift(chat);
+          }
           this.selectChat(chat);
         },
         error: (error) => {
@@ -1,7 +1,8 @@
 import { Injectable } from '@angular/core';
 import { HttpClient, HttpHeaders } from '@angular/common/http';
 import { Observable } from 'rxjs';
-import { WebSocketService, Chat, ChatMessage } from './websocket.service';
+import { map } from 'rxjs/operators';
+import { WebSocketService, Chat, ChatMessage, MessagePage, SyncPage } from './websocket.service';
 
 @Injectable({
   providedIn: 'root'
@@ -34,7 +35,45 @@ export class ChatService {
   }
 
   getMessages(chatId: number): Observable<ChatMessage[]> {
-    return this.http.get<ChatMessage[]>(`${this.apiUrl}/messages/?chat=${chatId}`, {
+    return this.getMessagePage(chatId).pipe(map(page => page.results));
+  }
+
+  getMessagePage(chatId: number, params: { before?: number, after?: number, pageSize?: number } = {}): Observable<MessagePage> {
+    let url = `${this.apiUrl}/messages/?chat=${chatId}`;
+    if (params.before) url += `&before=${params.before}`;
+    if (params.after) url += `&after=${params.after}`;
+    if (params.pageSize) url += `&page_size=${params.pageSize}`;
+    return this.http.get<MessagePage>(url, {
+      headers: this.getHeaders()
+    });
+  }
+
+  // Marks everything up to messageId (or the whole chat) as read.
+  markRead(chatId: number, messageId?: number): Observable<{last_read_message: number, unread_count: number}> {
+    return this.http.post<{last_read_message: number, unread_count: number}>(
+      `${this.apiUrl}/chats/${chatId}/read/`,
+      messageId ? { message: messageId } : {},
+      { headers: this.getHeaders() }
+    );
+  }
+
+  sendMessages(chatId: number, texts: string[]): Observable<ChatMessage[]> {
+    return this.http.post<ChatMessage[]>(`${this.apiUrl}/messages/bulk/`, {
+      chat: chatId,
+      messages: texts.map(text => ({ text }))
+    }, {
+      headers: this.getHeaders()
+    });
+  }
+
+  // Changes since cursor; without one (or after reset) refetch everything and keep the returned cursor.
+  sync(cursor?: number, limit?: number): Observable<SyncPage> {
+    let url = `${this.apiUrl}/sync/`;
+    const params: string[] = [];
+    if (cursor !== undefined) params.push(`cursor=${cursor}`);
+    if (limit) params.push(`limit=${limit}`);
+    if (params.length) url += `?${params.join('&')}`;
+    return this.http.get<SyncPage>(url, {
       headers: this.getHeaders()
     });
   }
@@ -14,6 +14,28 @@ export interface ChatMessage {
   sender_username?: string;
 }
 
+export interface MessagePage {
+  next: string | null;
+  previous: string | null;
+  results: ChatMessage[];
+}
+
+export interface SyncPage {
+  cursor: number;
+  reset: boolean;
+  has_more: boolean;
+  chats?: Chat[];
+  left_chats?: number[];
+  messages?: ChatMessage[];
+  deleted_messages?: number[];
+}
+
+export interface ReadReceipt {
+  chat_id: number;
+  user_id: number;
+  last_read_message: number;
+}
+
 export interface Chat {
   id: number;
   name: string;
@@ -27,6 +49,11 @@ export interface UserStatus {
   [userId: number]: boolean;
 }
 
+export interface PresenceSnapshot {
+  users: UserStatus;
+  version: number;
+}
+
 @Injectable({
   providedIn: 'root'
 })
@@ -39,12 +66,16 @@ export class WebSocketService {
   private newChatSubject = new Subject<Chat>();
   private connectionStatusSubject = new Subject<boolean>();
   private userStatusSubject = new Subject<{userId: number, isOnline: boolean}>();
+  // Presence version each user's status was last taken from; older events are stale.
+  private presenceVersions = new Map<number, number>();
   private searchResultsSubject = new Subject<any[]>();
+  private readReceiptSubject = new Subject<ReadReceipt>();
   
   public newMessage$ = this.newMessageSubject.asObservable();
   public newChat$ = this.newChatSubject.asObservable();
   public connectionStatus$ = this.connectionStatusSubject.asObservable();
   public userStatus$ = this.userStatusSubject.asObservable();
+  public readReceipt$ = this.readReceiptSubject.asObservable();
   public searchResults$ = this.searchResultsSubject.asObservable();
 
   constructor() {}
@@ -56,6 +87,7 @@ export class WebSocketService {
 
     try {
       this.socket = io(this.socketUrl, {
+        auth: { token },
         transports: ['websocket'],
         reconnection: true,
         reconnectionAttempts: 5,
@@ -63,7 +95,6 @@ export class WebSocketService {
       });
 
       this.setupEventListeners();
-      this.authenticate(token);
       
       this.startHeartbeat(token);
     } catch (error) {
@@ -72,12 +103,6 @@ export class WebSocketService {
     }
   }
 
-  private authenticate(token: string): void {
-    if (!this.socket) return;
-    
-    this.socket.emit('auth', { token });
-  }
-
   private setupEventListeners(): void {
     if (!this.socket) return;
 
@@ -106,17 +131,23 @@ export class WebSocketService {
       this.newMessageSubject.next(message);
     });
 
+    // Bulk-created messages arrive in batches.
+    this.socket.on('messages:created', (messages: ChatMessage[]) => {
+      messages.forEach(message => this.newMessageSubject.next(message));
+    });
+
+    this.socket.on('messages:read', (receipt: ReadReceipt) => {
+      this.readReceiptSubject.next(receipt);
+    });
+
     this.socket.on('chat:created', (chat: Chat) => {
       console.log('New chat created', chat);
       this.newChatSubject.next(chat);
     });
 
-    this.socket.on('user_status_changed', (data: {user_id: number, is_online: boolean}) => {
+    this.socket.on('user_status_changed', (data: {user_id: number, is_online: boolean, version: number}) => {
       console.log('User status changed', data);
-      this.userStatusSubject.next({
-        userId: data.user_id,
-        isOnline: data.is_online
-      });
+      this.applyStatus(data.user_id, data.is_online, data.version);
     });
 
     this.socket.on('search_results', (data: {users: any[]}) => {
@@ -124,13 +155,10 @@ export class WebSocketService {
       this.searchResultsSubject.next(data.users);
     });
 
-    this.socket.on('online_users', (statusMap: UserStatus) => {
-      console.log('Online users status received', statusMap);
-      Object.entries(statusMap).forEach(([userId, isOnline]) => {
-        this.userStatusSubject.next({
-          userId: Number(userId),
-          isOnline: isOnline
-        });
+    this.socket.on('online_users', (snapshot: PresenceSnapshot) => {
+      console.log('Online users status received', snapshot);
+      Object.entries(snapshot.users).forEach(([userId, isOnline]) => {
+        this.applyStatus(Number(userId), isOnline, snapshot.version);
       });
     });
 
@@ -139,6 +167,14 @@ export class WebSocketService {
     });
   }
 
+  private applyStatus(userId: number, isOnline: boolean, version: number): void {
+    if (version < (this.presenceVersions.get(userId) ?? 0)) {
+      return;
+    }
+    this.presenceVersions.set(userId, version);
+    this.userStatusSubject.next({userId, isOnline});
+  }
+
   private startHeartbeat(token: string): void {
     interval(30000)
       .pipe(takeWhile(() => this.connected))